@@ -1,4 +1,5 @@
 from os.path import dirname, join
+from multiprocessing import cpu_count
 import kivy
 from kivy.config import Config
 from kivy.resources import resource_add_path
@@ -20,6 +21,50 @@ resource_add_path(join(app_dir, 'icons'))
 results_dir = join(app_dir, 'results')
 web_root = 'http://mosculp.csail.mit.edu/demo-ui-data'
 tmp_root = '/tmp/mosculp_gui'
+disk_cache_bytes = 10 << 30  # for tmp_root, evicting the least recently used
+fetch_workers = 8  # parallel downloads, each on its own kept-alive connection
+fetch_timeout = 30  # seconds
+fetch_retries = 3  # resumed attempts after a dropped transfer
+predownload_workers = 4  # clips, or folders when extracting, predownloaded at a time
+# Predownload each clip into a single archive rather than thousands of files
+predownload_archive = True
+# Background downloads for the requests likely to come next: how many,
+# bytes per request, bytes per second, and disk space to leave free
+prefetch = True
+prefetch_candidates = 6
+prefetch_bytes = 200 << 20
+prefetch_rate = 4 << 20
+prefetch_min_free = 1 << 30
+
+# Compositing engine: 'basis' (reuses cached blurred weights across
+# transparencies), 'band' (blurs only near label boundaries), 'fused', or
+# 'simple' (the reference implementation)
+matting_engine = 'basis'
+basis_cache_bytes = 1 << 30  # memory for weight bases
+# Compositing precision: 'float64', 'float32', or 'fixed16' (8.8 fixed point);
+# the reduced ones stay within one 8-bit level of 'float64'
+comp_precision = 'float64'
+comp_mem_budget = None  # peak bytes per composite, or None for no limit
+# Compositing runs on row bands in this many threads; bands default to an
+# even split of the frame among the threads
+comp_workers = cpu_count()
+comp_tile_rows = None
+batch_workers = cpu_count()  # processes of batch_render.py, sharing comp_workers
+# Running sums and combined results kept for shadow backgrounds
+shadow_cache_size = 4
+img_cache_bytes = 1 << 30  # decoded ingredient images kept in memory
+raw_img_store = True  # keep uncompressed, memory-mappable copies of ingredients
+# Previews, shown while the full composite is made, are at the viewer's size,
+# or, before it is laid out, this many times smaller on each side
+progressive = True
+preview_factor = 4
+slider_interval = 0  # seconds of slider changes batched into one render; 0 for a frame
+texture_cache_bytes = 256 << 20  # recent composites kept as textures, to show again at once
+# Format of cached composites: 'png_fast', 'png', 'webp' (smallest, slowest to
+# save), or 'npy' (fastest, memory-mapped, but several times larger)
+result_codec = 'png_fast'
+idxmap_cache_size = 8  # parsed index maps kept in memory
+idxmap_compact = True  # keep compact, memory-mappable copies of index maps
 
 clips = ['Ballet-1', 'Ballet-2', 'Olympic', 'Cartwheel', 'Federer']
 readable2real = {
@@ -69,6 +114,9 @@ params_default = {
     'stickfig_density': 0,
     'sculp_transp': 0,
 }
+# Highest sculpture transparency: at 1, nothing would show where sculptures
+# overlap
+transp_max = 0.8
 
 myred = (0.52, 0.19, 0.29)
 myblue = (0.087, 0.39, 0.52)
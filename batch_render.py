@@ -0,0 +1,220 @@
+"""
+Renders a slice of the configuration space of clips into the composite
+cache ahead of time, e.g., each body part alone in leather or wood, under
+all three lights, at every density and transparency:
+
+    python batch_render.py Ballet-1 --mats Leather Wood --lights Left-Middle-Right
+
+Requests that share ingredients, i.e., differ only in transparency and
+background, are rendered together by one of several processes, so that
+their ingredients are loaded once.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from itertools import combinations, product
+from multiprocessing import Pool
+from os.path import exists
+from time import time
+from app_config import web_root, tmp_root, readable2real, body_parts, possible_mats, \
+    lights, comp_workers, batch_workers, transp_max
+from fetch import get_fetcher
+from clip_archive import clip_archives
+from composite_online import download_load_idxmaps, list_ingredients, \
+    load_ingredients, render, save_comp, cached_file, codec
+from disk_cache import disk_cache
+from prefetch import density_step, density_max, ingredients_key
+from req_key import normalize, req_hash, comp_file, migrate
+
+
+# As the sliders, which share the step in my.kv
+density_steps = [round(i * density_step, 2)
+                 for i in range(int(round(density_max / density_step)) + 1)]
+transp_steps = [round(i * density_step, 2)
+                for i in range(int(round(transp_max / density_step)) + 1)]
+
+
+def enumerate_reqs(clips, parts=body_parts, max_parts=1, mats=possible_mats,
+                   light_sets=None, specs=(True, False), densities=density_steps,
+                   transps=transp_steps, artistic_bgs=(False, True)):
+    """
+    Normalized requests, as (request, artistic_bg) pairs, of all
+    combinations of the given values: up to max_parts of parts, each in any
+    of mats, and light_sets, all non-empty sets of lights by default.
+    """
+    if light_sets is None:
+        light_sets = [list(c) for n in range(1, len(lights) + 1)
+                      for c in combinations(lights, n)]
+    seen = set()
+    for clip in clips:
+        for n in range(1, max_parts + 1):
+            for req_parts in combinations(parts, n):
+                for req_mats in product(mats, repeat=n):
+                    for l, spec, density, transp, artistic_bg in product(
+                            light_sets, specs, densities, transps, artistic_bgs):
+                        req = normalize({
+                            'clip': clip,
+                            'density': density,
+                            'lights': l,
+                            'transp': transp,
+                            'spec': spec,
+                            'part': req_parts,
+                            'mat': dict(zip(req_parts, req_mats)),
+                        })
+                        h = req_hash(req, artistic_bg)
+                        if h not in seen:
+                            seen.add(h)
+                            yield req, artistic_bg
+
+
+def group(reqs):
+    """
+    Requests grouped by the ingredients they need, with groups that share
+    index maps and frames next to each other.
+    """
+    groups = OrderedDict()
+    for req, artistic_bg in reqs:
+        groups.setdefault(ingredients_key(req), []).append((req, artistic_bg))
+    order = sorted(groups, key=lambda k: (k[0], k[1], [p for p, _ in k[4]], k))
+    return [groups[k] for k in order]
+
+
+def download(groups):
+    """
+    Downloads, all in parallel, what the groups need and is not in clip
+    archives. Returns download statistics.
+    """
+    fs = set()
+    for reqs in groups:
+        req = reqs[0][0]
+        precomp = download_load_idxmaps(req, web_root, tmp_root)
+        fs.update(f for _, f in list_ingredients(req, precomp)
+                  if clip_archives.find(tmp_root, f)[0] is None)
+    return get_fetcher(web_root).fetch_all(sorted(fs), tmp_root)
+
+
+def render_group(job):
+    # Runs in a worker process: loads the ingredients of a group once and
+    # renders all its requests. Returns the time of each stage, and what
+    # was added to the disk cache, for the parent to record.
+    reqs, threads = job
+    t_start = time()
+    stats = {'load': 0., 'composite': 0., 'save': 0., 'rendered': 0, 'error': None}
+    try:
+        t0 = time()
+        precomp, imgs = load_ingredients(reqs[0][0])
+        stats['load'] = time() - t0
+        for req, artistic_bg in reqs:
+            t0 = time()
+            comp = render(req, artistic_bg, precomp, imgs, workers=threads)
+            t1 = time()
+            save_comp(comp, comp_file(tmp_root, req, artistic_bg, codec.ext))
+            stats['composite'] += t1 - t0
+            stats['save'] += time() - t1
+            stats['rendered'] += 1
+    except Exception as e:  # pylint: disable=W0703
+        stats['error'] = "%s: %s" % (type(e).__name__, e)
+    stats['paths'] = disk_cache.changed_since(t_start)
+    return stats
+
+
+def batch_render(reqs, workers=batch_workers, force=False):
+    """
+    Renders requests, as (request, artistic_bg) pairs, not in the composite
+    cache, or all of them if force, with workers processes.
+    """
+    migrate(tmp_root)
+    reqs = list(reqs)
+    todo = [(req, artistic_bg) for req, artistic_bg in reqs
+            if force or cached_file(req, artistic_bg) is None]
+    groups = group(todo)
+    print("%d requests, %d cached, %d to render in %d groups" % (
+        len(reqs), len(reqs) - len(todo), len(todo), len(groups)))
+    if not groups:
+        return
+
+    # Downloads first, in this process, so that workers only read
+    t_start = time()
+    stats = download(groups)
+    print("Downloaded %(fetched)d of %(files)d files, %(bytes)dB "
+          "in %(seconds)fs (%(rate).0fB/s)" % stats)
+
+    threads = max(1, comp_workers // workers)
+    totals = {'load': 0., 'composite': 0., 'save': 0., 'rendered': 0}
+    n_done = 0
+    pool = Pool(workers)
+    try:
+        chunksize = max(1, len(groups) // (4 * workers))
+        for stats in pool.imap_unordered(
+                render_group, [(g, threads) for g in groups], chunksize):
+            for p in stats['paths']:
+                if exists(p):
+                    disk_cache.add(p)
+            for k in totals:
+                totals[k] += stats[k]
+            n_done += 1
+            if stats['error'] is not None:
+                print("Group %d of %d failed after %d requests: %s" % (
+                    n_done, len(groups), stats['rendered'], stats['error']))
+            else:
+                print("Group %d of %d rendered" % (n_done, len(groups)))
+    finally:
+        pool.close()
+        pool.join()
+    duration = time() - t_start
+
+    # Stage times are summed over the workers
+    print("Loaded ingredients of %d groups in %fs (%.2f groups/s per process)" % (
+        len(groups), totals['load'], len(groups) / max(totals['load'], 1e-6)))
+    print("Composited %d requests in %fs (%.2f/s per process)" % (
+        totals['rendered'], totals['composite'],
+        totals['rendered'] / max(totals['composite'], 1e-6)))
+    print("Saved %d composites in %fs (%.2f/s per process)" % (
+        totals['rendered'], totals['save'],
+        totals['rendered'] / max(totals['save'], 1e-6)))
+    print("Rendered %d of %d requests in %fs (%.2f/s) with %d processes" % (
+        totals['rendered'], len(todo), duration, totals['rendered'] / max(duration, 1e-6),
+        workers))
+    disk_cache.evict()
+    disk_cache.save()
+
+
+def main():
+    parser = ArgumentParser(description="Render composites ahead of time")
+    parser.add_argument('clips', nargs='+', choices=sorted(readable2real))
+    parser.add_argument('--parts', nargs='+', choices=body_parts, default=body_parts,
+                        help="body parts to combine")
+    parser.add_argument('--max-parts', type=int, default=1,
+                        help="most body parts in a request")
+    parser.add_argument('--mats', nargs='+', choices=possible_mats, default=possible_mats)
+    parser.add_argument('--lights', nargs='+',
+                        help="sets of lights, e.g., Left-Middle; all by default")
+    parser.add_argument('--spec', nargs='+', choices=['on', 'off'], default=['on', 'off'])
+    parser.add_argument('--density', nargs='+', type=float, default=density_steps)
+    parser.add_argument('--transp', nargs='+', type=float, default=transp_steps)
+    parser.add_argument('--artistic-bg', nargs='+', choices=['on', 'off'],
+                        default=['off', 'on'])
+    parser.add_argument('-j', '--workers', type=int, default=batch_workers,
+                        help="processes to render with")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="render again what is already cached")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="only count the requests")
+    args = parser.parse_args()
+    light_sets = None if args.lights is None else [l.split('-') for l in args.lights]
+    reqs = enumerate_reqs(
+        [readable2real[c] for c in args.clips], args.parts, args.max_parts, args.mats,
+        light_sets, [s == 'on' for s in args.spec], args.density, args.transp,
+        [b == 'on' for b in args.artistic_bg])
+    if args.dry_run:
+        reqs = list(reqs)
+        n_cached = sum(1 for req, artistic_bg in reqs
+                       if cached_file(req, artistic_bg) is not None)
+        print("%d requests, %d cached, in %d groups" % (
+            len(reqs), n_cached, len(group(reqs))))
+        return
+    batch_render(reqs, workers=args.workers, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
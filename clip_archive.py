@@ -0,0 +1,224 @@
+"""
+Clip archives hold all ingredient data of a clip in a single file: a header,
+the payloads of all members, and an index of where each member is. Readers
+memory-map the archive, so members cost no file opens. Existing .tar.gz
+folders convert with, e.g.,
+
+    python clip_archive.py Ballet-1 Cartwheel
+"""
+
+import json
+import struct
+import tarfile
+from argparse import ArgumentParser
+from io import BytesIO
+from mmap import mmap, ACCESS_READ
+from os import fdopen, remove, rename, stat
+from os.path import join, exists, dirname, normpath
+from tempfile import mkstemp
+from threading import Lock
+import numpy as np
+from app_config import tmp_root, readable2real
+from idxmap_cache import load_npz, compact_arrays, compact_path
+from disk_cache import disk_cache
+
+
+ARCHIVE_MAGIC = 'MOSCULPA'
+ARCHIVE_VERSION = 1
+# Magic, version, index offset and index size, padded to the alignment
+HEADER = '<8sIQQ'
+ALIGNMENT = 64  # of payloads, so that arrays can be viewed in place
+
+folders = [
+    'obj',
+    'frames_for-ui-resp',
+    'composite_enum_idxmap_for-ui-resp',
+    'render_enum_for-ui-resp',
+]
+
+
+def archive_path(tmp_root, clip_name):
+    return join(tmp_root, clip_name + '.archive')
+
+
+class ArchiveWriter(object):
+    """
+    Writes a clip archive, which appears at path only once closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd, self._tmp_f = mkstemp(dir=dirname(path))
+        self._h = fdopen(fd, 'wb')
+        self._h.write('\0' * ALIGNMENT)  # header, written on close
+        self._index = {}
+
+    def add(self, name, data):
+        pos = self._h.tell()
+        self._h.write('\0' * (-pos % ALIGNMENT))
+        self._index[name] = (self._h.tell(), len(data))
+        self._h.write(data)
+
+    def add_array(self, name, x):
+        buf = BytesIO()
+        np.save(buf, x)
+        self.add(name, buf.getvalue())
+
+    def add_tar(self, h):
+        """
+        Adds all files of an open tarfile, which may be a stream. Index maps
+        are added in the compact layout, too.
+        """
+        for member in h:
+            if not member.isfile():
+                continue
+            name = normpath(member.name)
+            data = h.extractfile(member).read()
+            self.add(name, data)
+            if name.endswith('.npz'):
+                arrays, meta = compact_arrays(load_npz(BytesIO(data)))
+                compact_dir = compact_path(name)
+                for k, x in arrays.iteritems():
+                    self.add_array(compact_dir + '/' + k, x)
+                self.add(compact_dir + '/meta.json', json.dumps(meta))
+
+    def mark(self):
+        return self._h.tell(), dict(self._index)
+
+    def rollback(self, mark):
+        # Drops members added since mark, e.g., of a failed download
+        pos, self._index = mark
+        self._h.seek(pos)
+        self._h.truncate()
+
+    def close(self):
+        index = json.dumps(self._index)
+        index_offset = self._h.tell()
+        self._h.write(index)
+        self._h.seek(0)
+        self._h.write(struct.pack(HEADER, ARCHIVE_MAGIC, ARCHIVE_VERSION,
+                                  index_offset, len(index)))
+        self._h.close()
+        rename(self._tmp_f, self.path)
+        disk_cache.add(self.path)
+
+    def abort(self):
+        self._h.close()
+        remove(self._tmp_f)
+
+
+class ClipArchive(object):
+    """
+    Memory-mapped clip archive, with members named by their paths relative
+    to the clip folder.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as h:
+            self._mm = mmap(h.fileno(), 0, access=ACCESS_READ)
+        magic, version, index_offset, index_size = struct.unpack_from(HEADER, self._mm)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            raise ValueError("%s is not a version %d clip archive" % (path, ARCHIVE_VERSION))
+        self.index = json.loads(self._mm[index_offset:(index_offset + index_size)])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def read(self, name):
+        offset, size = self.index[name]
+        return self._mm[offset:(offset + size)]
+
+    def open(self, name):
+        return BytesIO(self.read(name))
+
+    def array(self, name):
+        """
+        Array of a .npy member, viewed in place, so read-only.
+        """
+        offset, size = self.index[name]
+        h = BytesIO(self._mm[offset:(offset + min(size, 4096))])
+        if np.lib.format.read_magic(h) == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(h)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(h)
+        x = np.frombuffer(self._mm, dtype=dtype, count=int(np.prod(shape)),
+                          offset=offset + h.tell())
+        return x.reshape(shape, order='F' if fortran_order else 'C')
+
+
+class ClipArchives(object):
+    """
+    Open clip archives, reopened when replaced on disk.
+    """
+
+    def __init__(self):
+        self._archives = {}
+        self._lock = Lock()
+
+    def get(self, tmp_root, clip_name):
+        """
+        Archive of clip_name under tmp_root, or None if there is none.
+        """
+        path = archive_path(tmp_root, clip_name)
+        if not disk_cache.contains(path):
+            return None
+        try:
+            st = stat(path)
+        except OSError:  # removed meanwhile, e.g., by another process
+            disk_cache.forget(path)
+            return None
+        stamp = (st.st_size, st.st_mtime, st.st_ino)
+        with self._lock:
+            archive, archive_stamp = self._archives.get(path, (None, None))
+            if archive is None or archive_stamp != stamp:
+                archive = ClipArchive(path)
+                self._archives[path] = (archive, stamp)
+            return archive
+
+    def find(self, tmp_root, f):
+        """
+        Archive holding f, relative to tmp_root, and its name there, or
+        (None, None) if f is in no archive.
+        """
+        clip_name, name = f.split('/', 1)
+        archive = self.get(tmp_root, clip_name)
+        if archive is None or name not in archive:
+            return None, None
+        return archive, name
+
+
+clip_archives = ClipArchives()
+
+
+def convert(clip_name, tmp_root=tmp_root, folders=folders):
+    """
+    Converts the .tar.gz folders of a clip under tmp_root to its archive.
+    """
+    writer = ArchiveWriter(archive_path(tmp_root, clip_name))
+    try:
+        for folder in folders:
+            tar_f = join(tmp_root, clip_name, folder + '.tar.gz')
+            if not exists(tar_f):
+                raise IOError("%s missing; predownload the clip first" % tar_f)
+            h = tarfile.open(tar_f, 'r|gz')
+            writer.add_tar(h)
+            h.close()
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def main():
+    parser = ArgumentParser(description="Convert .tar.gz folders of clips to clip archives")
+    parser.add_argument('clips', nargs='+', choices=sorted(readable2real))
+    args = parser.parse_args()
+    for clip_name in args.clips:
+        convert(readable2real[clip_name])
+        print("Converted %s to %s" % (
+            clip_name, archive_path(tmp_root, readable2real[clip_name])))
+
+
+if __name__ == '__main__':
+    main()
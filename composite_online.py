@@ -1,18 +1,30 @@
 # pylint: disable=W0621
 
 from sys import stdout
-from os import makedirs
-from os.path import join, exists, dirname
+from os import rename, fdopen
+from os.path import join, dirname
+from collections import OrderedDict
+from hashlib import sha1
+from tempfile import mkstemp
+from threading import Condition, Lock, Thread
+from multiprocessing.pool import ThreadPool
 from urllib import FancyURLopener
 from time import time
+import atexit
 import numpy as np
 from PIL import Image
-from scipy.ndimage.filters import gaussian_filter
-from app_config import web_root, tmp_root
-
-
-class FileNotOnServerException(Exception):
-    pass
+from scipy.ndimage.filters import gaussian_filter, maximum_filter, minimum_filter
+from scipy.ndimage.measurements import find_objects
+from app_config import web_root, tmp_root, matting_engine, basis_cache_bytes, \
+    comp_precision, comp_mem_budget, comp_workers, comp_tile_rows, shadow_cache_size, \
+    preview_factor, result_codec
+from img_cache import decoded_imgs
+from idxmap_cache import idxmaps
+from clip_archive import clip_archives, archive_path
+from disk_cache import disk_cache
+from req_key import normalize, comp_file, migrate, req_hash
+from fetch import FileNotOnServerException, get_fetcher, retrieve
+from result_codec import codecs, get_codec, codec_of
 
 
 class MyURLopener(FancyURLopener):
@@ -20,12 +32,9 @@ class MyURLopener(FancyURLopener):
         raise FileNotOnServerException(url)
 
     def lazy_retrieve(self, remote_f, local_f):
-        if not exists(local_f):
+        if not (disk_cache.contains(local_f) and disk_cache.verified(local_f)):
             print("Downloading to %s" % local_f)
-            local_dir = dirname(local_f)
-            if not exists(local_dir):
-                makedirs(local_dir)
-            self.retrieve(remote_f, local_f, self.report_hook)
+            retrieve(remote_f, local_f, self.report_hook)
         else:
             print("%s already exists -- download skipped" % local_f)
 
@@ -44,24 +53,37 @@ class MyURLopener(FancyURLopener):
         stdout.flush()
 
 
+def idxmap_file(req):
+    # Index map file of a request, relative to the web root
+    return join(req['clip'], 'composite_enum_idxmap_for-ui-resp',
+                'density.%.2f_part.%s.npz' %
+                (req['density'], '-'.join(sorted(req['part']))))
+
+
 def download_load_idxmaps(req, web_root, tmp_root):
-    folder = join(req['clip'], 'composite_enum_idxmap_for-ui-resp')
-    local_dir = join(tmp_root, folder)
-    if not exists(local_dir):
-        makedirs(local_dir)
-    f = join(folder, 'density.%.2f_part.%s.npz' %
-             (req['density'], '-'.join(sorted(req['part']))))
+    f = idxmap_file(req)
+    # From the clip archive if predownloaded into one
+    archive, name = clip_archives.find(tmp_root, f)
+    if archive is not None:
+        return idxmaps.load(name, archive)
     remote_f = join(web_root, f)
     local_f = join(tmp_root, f)
     MyURLopener().lazy_retrieve(remote_f, local_f)
-    precomp = dict(np.load(local_f))
-    precomp['idx_names'] = list(precomp['idx_names'])
-    return precomp
+    try:
+        return idxmaps.load(local_f)
+    except (IOError, OSError):
+        # Indexed, but removed meanwhile, e.g., by another process
+        disk_cache.forget(local_f)
+        MyURLopener().lazy_retrieve(remote_f, local_f)
+        return idxmaps.load(local_f)
 
 
-def download_load_imgs(req, precomp, web_root, tmp_root):
-    # Load frames
-    imgs = {}
+def list_ingredients(req, precomp, skip_bgs=()):
+    """
+    Image ingredients of a request, as (key, path relative to the web root)
+    pairs.
+    """
+    ingredients = []
     for idx_name in precomp['idx_names']:
         if 'sculp_' in idx_name:
             part_name = idx_name.replace('sculp_', '')
@@ -74,49 +96,87 @@ def download_load_imgs(req, precomp, web_root, tmp_root):
                 'lights.%s_density.%.2f.blend' % (
                     '-'.join(sorted(req['lights'])), req['density']),
             )
-            if not exists(join(tmp_root, folder)):
-                makedirs(join(tmp_root, folder))
-
-            # Load sculpture RGB
-            remote_f = join(web_root, folder, 'sculp_rgb.jpg')
-            local_f = join(tmp_root, folder, 'sculp_rgb.jpg')
-            MyURLopener().lazy_retrieve(remote_f, local_f)
-            imgs[idx_name] = np.array(Image.open(local_f))
-
-            # Load backgrounds
-            remote_f = join(web_root, folder, 'shadowbg.jpg')
-            local_f = join(tmp_root, folder, 'shadowbg.jpg')
-            MyURLopener().lazy_retrieve(remote_f, local_f)
-            imgs['bg_' + part_name] = np.array(Image.open(local_f))
-            # remote_f = join(web_root, folder, 'shadowbg_bwall.jpg')
-            # local_f = join(tmp_root, folder, 'shadowbg_bwall.jpg')
-            # MyURLopener().lazy_retrieve(remote_f, local_f)
-            # imgs['bg_bwall_' + part_name] = np.array(Image.open(local_f))
+
+            # Sculpture RGB
+            ingredients.append((idx_name, join(folder, 'sculp_rgb.jpg')))
+
+            # Backgrounds, unless the caller has them already
+            if part_name in skip_bgs:
+                continue
+            ingredients.append(('bg_' + part_name, join(folder, 'shadowbg.jpg')))
+            # ingredients.append(('bg_bwall_' + part_name, join(folder, 'shadowbg_bwall.jpg')))
 
         else:
-            # Load frames
-            remote_f = join(web_root, req['clip'], 'frames_for-ui-resp', idx_name + '.jpg')
-            local_dir = join(tmp_root, req['clip'], 'frames_for-ui-resp')
-            local_f = join(local_dir, idx_name + '.jpg')
-            if not exists(local_dir):
-                makedirs(local_dir)
-            MyURLopener().lazy_retrieve(remote_f, local_f)
-            imgs[idx_name] = np.array(Image.open(local_f))
+            # Frames
+            ingredients.append((idx_name, join(
+                req['clip'], 'frames_for-ui-resp', idx_name + '.jpg')))
+    return ingredients
 
-    return imgs
+
+def download_load_imgs(req, precomp, web_root, tmp_root, skip_bgs=(), factor=1):
+    """
+    With factor, images are loaded reduced by it, as for previews.
+    """
+    ingredients = list_ingredients(req, precomp, skip_bgs)
+
+    # Those not in the clip archive, if any, are downloaded, all in parallel
+    archive = clip_archives.get(tmp_root, req['clip'])
+    names = [f.split('/', 1)[1] for _, f in ingredients]
+    if archive is not None:
+        archived = [name in archive for name in names]
+    else:
+        archived = [False] * len(ingredients)
+    stats = get_fetcher(web_root).fetch_all(
+        [f for (_, f), a in zip(ingredients, archived) if not a], tmp_root)
+    print("Downloaded %(fetched)d of %(files)d files, %(bytes)dB "
+          "in %(seconds)fs (%(rate).0fB/s)" % stats)
+
+    # Load, decoding on several threads
+    def decode(path, opener):
+        if factor > 1:
+            return decoded_imgs.load_scaled(path, factor, opener)
+        return decoded_imgs.load(path, opener)
+
+    def load(job):
+        (key, f), name, a = job
+        path = join(tmp_root, f)
+        if a:
+            return key, decode(path, lambda: archive.open(name))
+        try:
+            return key, decode(path, None)
+        except (IOError, OSError):
+            # Indexed, but removed meanwhile, e.g., by another process
+            disk_cache.forget(path)
+            get_fetcher(web_root).fetch(f, path)
+            return key, decode(path, None)
+
+    jobs = zip(ingredients, names, archived)
+    if comp_workers > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(comp_workers, len(jobs)))
+        try:
+            loaded = pool.map(load, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        loaded = [load(job) for job in jobs]
+    return dict(loaded)
 
 
-def combine_shadow(imgs):
-    bg_rgbs = []
+def combine_shadow(imgs, precision='float64'):
+    bg_sum, n_bgs = None, 0
     # bg_bwall_rgbs = []
     for key, img in imgs.iteritems():
         if key.startswith('bg_'):
-            bg_rgbs.append(img)
+            # Integer sum is exact for up to 257 8-bit images
+            if bg_sum is None:
+                bg_sum = np.zeros(img.shape, dtype=np.uint16)
+            bg_sum += img
+            n_bgs += 1
         # elif key.startswith('bg_bwall_'):
         #    bg_bwall_rgbs.append(img)
-    bg_rgbs = np.stack(bg_rgbs, axis=3)
     # bg_bwall_rgbs = np.stack(bg_bwall_rgbs, axis=3)
-    bg_rgb = np.mean(bg_rgbs, axis=3)
+    bg_rgb = _mean_from_sum(bg_sum, n_bgs, precision)
     # bg_bwall_rgb = np.mean(bg_bwall_rgbs, axis=3)
     imgs = {k: v for k, v in imgs.iteritems() if not k.startswith('bg_')}
     imgs['bg'] = bg_rgb
@@ -124,7 +184,114 @@ def combine_shadow(imgs):
     return imgs
 
 
-def simple_matting(imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp, kernel_size):
+# Weight map and composite types of each precision mode. 'fixed16' accumulates
+# the composite in 8.8 fixed point.
+precisions = {
+    'float64': (np.float64, np.float64),
+    'float32': (np.float32, np.float32),
+    'fixed16': (np.float32, np.uint16),
+}
+
+
+def _mean_from_sum(img_sum, n, precision):
+    if precision == 'fixed16':
+        return ((img_sum + n // 2) // n).astype(np.uint8)  # rounded
+    return np.true_divide(img_sum, n, dtype=precisions[precision][0])
+
+
+def _to_comp(x, comp):
+    # Weighted layer values in the number format of the composite
+    if comp.dtype == np.uint16:
+        # Normalized weights keep the sum within 255 * 256
+        return np.rint(x * 256.).astype(np.uint16)
+    return x
+
+
+def _finish(comp):
+    if comp.dtype == np.uint16:
+        return (comp >> 8).astype(np.uint8)  # truncated, like the float paths
+    return comp
+
+
+class ShadowAccumulator(object):
+    """
+    Combines shadow backgrounds incrementally. The per-part backgrounds of a
+    request depend on (clip, specularity, lights, density) and on each
+    part's material; for each such base, a running sum of the current parts'
+    backgrounds is kept, so toggling a part or its material costs one add
+    and/or subtract. Combined backgrounds are also cached by request.
+    """
+
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self._sums = OrderedDict()  # base -> [sum, {(part, mat): background}]
+        self._combined = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _keys(req):
+        base = (req['clip'], bool(req['spec']), tuple(sorted(req['lights'])),
+                '%.2f' % req['density'])
+        members = tuple(sorted((p, req['mat'][p]) for p in req['part']))
+        return base, members
+
+    def cached_parts(self, req, precision='float64'):
+        """
+        Parts whose backgrounds combine() would not need to be given.
+        """
+        base, members = self._keys(req)
+        with self._lock:
+            if (base, members, precision) in self._combined:
+                return set(req['part'])
+            if base not in self._sums:
+                return set()
+            in_sum = self._sums[base][1]
+            return set(p for p, m in members if (p, m) in in_sum)
+
+    def combine(self, req, imgs, precision='float64'):
+        """
+        Same as combine_shadow(), for the images of the given request, which
+        may leave out the backgrounds of cached_parts().
+        """
+        base, members = self._keys(req)
+        key = (base, members, precision)
+        with self._lock:
+            if key in self._combined:
+                bg_rgb = self._combined.pop(key)
+            else:
+                if base in self._sums:
+                    bg_sum, in_sum = self._sums.pop(base)
+                else:
+                    bg_sum, in_sum = None, {}
+                for member in set(in_sum) - set(members):
+                    bg_sum -= in_sum.pop(member)
+                for part, mat in members:
+                    if (part, mat) not in in_sum:
+                        img = imgs['bg_' + part]
+                        if bg_sum is None:
+                            bg_sum = np.zeros(img.shape, dtype=np.uint16)
+                        bg_sum += img
+                        in_sum[(part, mat)] = img
+                self._sums[base] = [bg_sum, in_sum]
+                while len(self._sums) > self.cache_size:
+                    self._sums.popitem(last=False)
+                bg_rgb = _mean_from_sum(bg_sum, len(members), precision)
+            self._combined[key] = bg_rgb  # most recently used
+            while len(self._combined) > self.cache_size:
+                self._combined.popitem(last=False)
+        imgs = {k: v for k, v in imgs.iteritems() if not k.startswith('bg_')}
+        imgs['bg'] = bg_rgb
+        return imgs
+
+
+shadow_bgs = ShadowAccumulator(shadow_cache_size)
+
+
+def simple_matting(imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp, kernel_size,
+                   precision='float64', offsets=None):
+    w_dtype, comp_dtype = precisions[precision]
+    if offsets:
+        imgs = _place(imgs, offsets, curr_idx_map.shape)
     # Generate nImgs-by-h-by-w cube for blending the human images
     is_sculp = np.zeros(curr_idx_map.shape, dtype=bool)
     for i, idx_name in enumerate(idx_names):
@@ -133,9 +300,9 @@ def simple_matting(imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp, ke
     w_cube, img_cube = [], []
     for i, idx_name in enumerate(idx_names):
         if idx_name.startswith('sculp'):
-            w_map = (1 - sculp_transp) * (curr_idx_map == i).astype('double')
+            w_map = (1 - sculp_transp) * (curr_idx_map == i).astype(w_dtype)
         else:
-            w_map = (curr_idx_map == i).astype('double')
+            w_map = (curr_idx_map == i).astype(w_dtype)
             w_map[np.logical_and(is_sculp, prev_idx_map == i)] = sculp_transp
         w_map = gaussian_filter(w_map, kernel_size) # sigma is 0.3*((ksize-1)*0.5-1)+0.8
         w_cube.append(w_map)
@@ -147,14 +314,531 @@ def simple_matting(imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp, ke
     w_sum = np.sum(w_cube, axis=2)
     w_cube = np.true_divide(w_cube, np.repeat(w_sum[..., np.newaxis], w_cube.shape[2], axis=2))
     # Composite
-    comp = np.zeros(img_shape)
+    comp = np.zeros(img_shape, dtype=comp_dtype)
     for c in range(3):
-        comp[:, :, c] = np.sum(np.multiply(w_cube, img_cube[:, :, c, :]), axis=2)
+        comp[:, :, c] = _to_comp(
+            np.sum(np.multiply(w_cube, img_cube[:, :, c, :]), axis=2), comp)
+    return _finish(comp)
+
+
+def _overlap(box, img_shape, offset):
+    """
+    Where a layer placed at the given offset of the index maps overlaps with a
+    box of the index maps, as slices into the box and into the layer.
+    """
+    box_slices, img_slices = [], []
+    for s, n, o in zip(box, img_shape[:2], offset):
+        start, stop = max(s.start, o), min(s.stop, o + n)
+        stop = max(start, stop)
+        box_slices.append(slice(start - s.start, stop - s.start))
+        img_slices.append(slice(start - o, stop - o))
+    return tuple(box_slices), tuple(img_slices)
+
+
+def _place(imgs, offsets, shape):
+    # Layers as full copies the size of the index maps, zero where uncovered
+    placed = dict(imgs)
+    for k, offset in offsets.iteritems():
+        img = imgs[k]
+        placed[k] = np.zeros(shape + img.shape[2:], dtype=img.dtype)
+        box_slices, img_slices = _overlap(
+            (slice(0, shape[0]), slice(0, shape[1])), img.shape, offset)
+        placed[k][box_slices] = img[img_slices]
+    return placed
+
+
+def _accumulate(comp, box, w_map, img, offset):
+    # Adds weighted layer to the box of the composite that the weights cover
+    box_slices, img_slices = _overlap(box, img.shape, offset)
+    comp[box][box_slices] += _to_comp(
+        w_map[box_slices][..., np.newaxis] * img[img_slices], comp)
+
+
+def _kernel_radius(kernel_size, truncate=4.0):
+    # Support radius of gaussian_filter() with its default truncation
+    return int(truncate * float(kernel_size) + 0.5)
+
+
+def _label_maps(prev_idx_map, curr_idx_map, idx_names):
+    curr_idx_map = curr_idx_map.astype(int)  # padded maps are float
+    prev_idx_map = prev_idx_map.astype(int)
+    # Label -> property lookups, gathered by index maps
+    sculp_labels = np.array([x.startswith('sculp_') for x in idx_names])
+    is_sculp = sculp_labels[curr_idx_map]
+    # Where frames show through the transparent sculpture
+    is_seethru = np.logical_and(is_sculp, ~sculp_labels[prev_idx_map])
+    return prev_idx_map, curr_idx_map, is_sculp, is_seethru
+
+
+def _weight_map(i, idx_name, prev_idx_map, curr_idx_map, is_seethru, sculp_transp,
+                w_dtype):
+    if idx_name.startswith('sculp'):
+        w_map = (1 - sculp_transp) * (curr_idx_map == i).astype(w_dtype)
+    else:
+        w_map = (curr_idx_map == i).astype(w_dtype)
+        w_map[np.logical_and(is_seethru, prev_idx_map == i)] = sculp_transp
+    return w_map
+
+
+def _weight_sum(is_sculp, is_seethru, sculp_transp, kernel_size, w_dtype):
+    # Blurring is linear, so this equals the sum of all blurred weight maps
+    w_sum = np.where(is_sculp, 1 - sculp_transp, 1.).astype(w_dtype)
+    w_sum[is_seethru] += sculp_transp
+    return gaussian_filter(w_sum, kernel_size)
+
+
+def fused_matting(imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp, kernel_size,
+                  precision='float64', offsets=None):
+    """
+    Same result as simple_matting(), but without the nImgs-deep weight and
+    image cubes: each layer's blurred weight map is normalized and
+    accumulated into the composite right away. The weight sum is the blur of
+    the (unblurred) weight sum, which costs one extra gaussian_filter() call
+    instead of a stack of all weight maps.
+
+    Layers may be smaller than the index maps, placed at the (row, column)
+    offsets given by name, and are treated as zero where they do not reach.
+    """
+    offsets = offsets or {}
+    prev_idx_map, curr_idx_map, is_sculp, is_seethru = _label_maps(
+        prev_idx_map, curr_idx_map, idx_names)
+    n_labels = len(idx_names)
+    # Skip layers not present in either map
+    n_curr = np.bincount(curr_idx_map.ravel(), minlength=n_labels)
+    n_seethru = np.bincount(prev_idx_map[is_seethru], minlength=n_labels)
+    w_dtype, comp_dtype = precisions[precision]
+    w_sum = _weight_sum(is_sculp, is_seethru, sculp_transp, kernel_size, w_dtype)
+    # Composite
+    shape = curr_idx_map.shape
+    box = (slice(0, shape[0]), slice(0, shape[1]))
+    comp = np.zeros(shape + imgs[idx_names[0]].shape[2:], dtype=comp_dtype)
+    for i, idx_name in enumerate(idx_names):
+        if n_curr[i] == 0 and n_seethru[i] == 0:
+            continue
+        w_map = _weight_map(
+            i, idx_name, prev_idx_map, curr_idx_map, is_seethru, sculp_transp,
+            w_dtype)
+        w_map = gaussian_filter(w_map, kernel_size)
+        w_map /= w_sum
+        _accumulate(comp, box, w_map, imgs[idx_name], offsets.get(idx_name, (0, 0)))
+    return _finish(comp)
+
+
+def _grow(box, margin, shape):
+    return tuple(
+        slice(max(s.start - margin, 0), min(s.stop + margin, n))
+        for s, n in zip(box, shape)
+    )
+
+
+def _union(box1, box2):
+    if box1 is None or box2 is None:
+        return box1 or box2
+    return tuple(
+        slice(min(s1.start, s2.start), max(s1.stop, s2.stop))
+        for s1, s2 in zip(box1, box2)
+    )
+
+
+def _gather(comp_flat, width, pix, labels, imgs, idx_names, offsets, weight=1.):
+    """
+    Adds weight times each pixel's owning layer to the flattened composite.
+    """
+    order = np.argsort(labels, kind='mergesort')
+    pix, labels = pix[order], labels[order]
+    uniq, starts = np.unique(labels, return_index=True)
+    stops = np.append(starts[1:], len(labels))
+    for i, start, stop in zip(uniq, starts, stops):
+        img = imgs[idx_names[i]]
+        p = pix[start:stop]
+        # To layer coordinates
+        oy, ox = offsets.get(idx_names[i], (0, 0))
+        y, x = np.divmod(p, width)
+        y -= oy
+        x -= ox
+        inside = (y >= 0) & (y < img.shape[0]) & (x >= 0) & (x < img.shape[1])
+        p = p[inside]
+        vals = img[y[inside], x[inside]]
+        if weight != 1:
+            vals = weight * vals
+        comp_flat[p] += _to_comp(vals, comp_flat)
+
+
+def band_matting(imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp, kernel_size,
+                 precision='float64', offsets=None):
+    """
+    Same result as fused_matting(), but blurs and normalizes weights only in
+    the band around label boundaries. Elsewhere all weight maps are constant
+    over the Gaussian support, so blurring is a no-op and pixels are taken
+    directly from their owning layer (blended with the frame behind, if it is
+    a transparent sculpture).
+    """
+    offsets = offsets or {}
+    prev_idx_map, curr_idx_map, is_sculp, is_seethru = _label_maps(
+        prev_idx_map, curr_idx_map, idx_names)
+    n_labels = len(idx_names)
+    shape = curr_idx_map.shape
+    r = _kernel_radius(kernel_size)
+
+    # Weights of a pixel depend only on this key, so the band is where the key
+    # is not constant within the kernel support
+    key = np.where(
+        is_seethru, curr_idx_map + n_labels * (prev_idx_map + 1), curr_idx_map)
+    band = maximum_filter(key, 2 * r + 1) != minimum_filter(key, 2 * r + 1)
+
+    # Interior
+    w_dtype, comp_dtype = precisions[precision]
+    comp = np.zeros(shape + imgs[idx_names[0]].shape[2:], dtype=comp_dtype)
+    comp_flat = comp.reshape(-1, comp.shape[-1])
+    pix = np.flatnonzero(~band)
+    is_blend = is_seethru.ravel()[pix]
+    _gather(comp_flat, shape[1], pix[~is_blend],
+            curr_idx_map.ravel()[pix[~is_blend]], imgs, idx_names, offsets)
+    pix = pix[is_blend]
+    if pix.size > 0:
+        w_sum = (1 - sculp_transp) + sculp_transp
+        _gather(comp_flat, shape[1], pix, curr_idx_map.ravel()[pix], imgs,
+                idx_names, offsets, (1 - sculp_transp) / w_sum)
+        _gather(comp_flat, shape[1], pix, prev_idx_map.ravel()[pix], imgs,
+                idx_names, offsets, sculp_transp / w_sum)
+
+    # Band, visiting for each layer only the part of the band its blurred
+    # weights can reach
+    w_sum = _weight_sum(is_sculp, is_seethru, sculp_transp, kernel_size, w_dtype)
+    boxes_curr = find_objects(curr_idx_map + 1, n_labels)
+    boxes_prev = find_objects(
+        np.where(is_seethru, prev_idx_map + 1, 0), n_labels)
+    for i, idx_name in enumerate(idx_names):
+        box = _union(boxes_curr[i], boxes_prev[i])
+        if box is None:
+            continue
+        box = _grow(box, r, shape)
+        rows = np.flatnonzero(band[box].any(axis=1))
+        if rows.size == 0:
+            continue
+        cols = np.flatnonzero(band[box].any(axis=0))
+        out = (
+            slice(box[0].start + rows[0], box[0].start + rows[-1] + 1),
+            slice(box[1].start + cols[0], box[1].start + cols[-1] + 1),
+        )
+        # Blur with enough margin for the output to be exact
+        win = _grow(out, r, shape)
+        w_map = _weight_map(
+            i, idx_name, prev_idx_map[win], curr_idx_map[win], is_seethru[win],
+            sculp_transp, w_dtype)
+        w_map = gaussian_filter(w_map, kernel_size)
+        w_map = w_map[out[0].start - win[0].start:out[0].stop - win[0].start,
+                      out[1].start - win[1].start:out[1].stop - win[1].start]
+        img = imgs[idx_name]
+        box_slices, img_slices = _overlap(out, img.shape, offsets.get(idx_name, (0, 0)))
+        is_band = band[out][box_slices]
+        w = w_map[box_slices][is_band] / w_sum[out][box_slices][is_band]
+        comp[out][box_slices][is_band] += _to_comp(
+            w[:, np.newaxis] * img[img_slices][is_band], comp)
+    return _finish(comp)
+
+
+def _box_array(box):
+    return np.array([box[0].start, box[0].stop, box[1].start, box[1].stop])
+
+
+def _box_slices(box_array):
+    y0, y1, x0, x1 = box_array
+    return slice(y0, y1), slice(x0, x1)
+
+
+def compute_weight_basis(prev_idx_map, curr_idx_map, idx_names, kernel_size,
+                         w_dtype='double'):
+    """
+    Transparency-independent part of the matting weights. With transparency
+    t, the weight map of a layer is s * A + t * B, where s is 1 - t for
+    sculptures and 1 for frames, A is the layer's blurred mask in the current
+    index map, and B the blurred mask of where the frame shows through a
+    transparent sculpture. Maps are cropped to where they can be nonzero.
+    """
+    prev_idx_map, curr_idx_map, is_sculp, is_seethru = _label_maps(
+        prev_idx_map, curr_idx_map, idx_names)
+    n_labels = len(idx_names)
+    shape = curr_idx_map.shape
+    r = _kernel_radius(kernel_size)
+    basis = {'shape': np.array(shape)}
+    # Per layer
+    boxes_curr = find_objects(curr_idx_map + 1, n_labels)
+    boxes_prev = find_objects(
+        np.where(is_seethru, prev_idx_map + 1, 0), n_labels)
+    for i in range(n_labels):
+        if boxes_curr[i] is not None:
+            box = _grow(boxes_curr[i], r, shape)
+            mask = curr_idx_map[box] == i
+            basis['a_%d' % i] = gaussian_filter(
+                mask.astype(w_dtype), kernel_size)
+            basis['a_%d_box' % i] = _box_array(box)
+        if boxes_prev[i] is not None:
+            box = _grow(boxes_prev[i], r, shape)
+            mask = np.logical_and(is_seethru[box], prev_idx_map[box] == i)
+            basis['b_%d' % i] = gaussian_filter(
+                mask.astype(w_dtype), kernel_size)
+            basis['b_%d_box' % i] = _box_array(box)
+    # For the weight sum, which is 1 away from sculptures
+    box = find_objects(is_sculp.astype(int), 1)[0]
+    if box is not None:
+        box = _grow(box, r, shape)
+        basis['sculp'] = gaussian_filter(
+            is_sculp[box].astype(w_dtype), kernel_size)
+        basis['seethru'] = gaussian_filter(
+            is_seethru[box].astype(w_dtype), kernel_size)
+        basis['sculp_box'] = _box_array(box)
+    return basis
+
+
+_weight_bases = OrderedDict()
+_weight_bases_lock = Lock()
+_weight_bases_nbytes = [0]
+
+
+def load_weight_basis(prev_idx_map, curr_idx_map, idx_names, kernel_size,
+                      w_dtype='double'):
+    """
+    Weight basis of the given index maps, from memory, from disk under
+    tmp_root, or computed (and then cached in both) as a last resort. Bases
+    are keyed by the content of their inputs.
+    """
+    h = sha1()
+    for x in (prev_idx_map, curr_idx_map):
+        x = np.ascontiguousarray(x)
+        h.update(str(x.dtype) + str(x.shape))
+        h.update(x)
+    h.update(repr([n.startswith('sculp_') for n in idx_names]))
+    h.update(repr(float(kernel_size)) + np.dtype(w_dtype).name)
+    key = h.hexdigest()
+
+    with _weight_bases_lock:
+        if key in _weight_bases:
+            _weight_bases[key] = _weight_bases.pop(key)  # most recently used
+            return _weight_bases[key]
+
+    local_dir = join(tmp_root, 'weight_basis')
+    local_f = join(local_dir, key + '.npz')
+    disk_cache.pin([local_f])  # not evicted while read
+    try:
+        cached = disk_cache.contains(local_f)
+        if cached:
+            basis = dict(np.load(local_f))
+            disk_cache.touch([local_f])
+    except (IOError, OSError):
+        # Indexed, but removed meanwhile, e.g., by another process
+        disk_cache.forget(local_f)
+        cached = False
+    finally:
+        disk_cache.unpin([local_f])
+    if not cached:
+        basis = compute_weight_basis(
+            prev_idx_map, curr_idx_map, idx_names, kernel_size, w_dtype)
+        disk_cache.ensure_dirs([local_dir])
+        fd, tmp_f = mkstemp(dir=local_dir)
+        with fdopen(fd, 'wb') as h:
+            np.savez(h, **basis)
+        rename(tmp_f, local_f)  # so that no one reads a partial file
+        disk_cache.add(local_f)
+
+    with _weight_bases_lock:
+        if key not in _weight_bases:
+            _weight_bases[key] = basis
+            _weight_bases_nbytes[0] += sum(x.nbytes for x in basis.values())
+        while _weight_bases_nbytes[0] > basis_cache_bytes and len(_weight_bases) > 1:
+            _, evicted = _weight_bases.popitem(last=False)
+            _weight_bases_nbytes[0] -= sum(x.nbytes for x in evicted.values())
+    return basis
+
+
+def basis_matting(imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp, kernel_size,
+                  precision='float64', offsets=None):
+    """
+    Same result as fused_matting(), but from cached weight bases, so that no
+    blurring is needed when only the sculpture transparency changes.
+    """
+    offsets = offsets or {}
+    w_dtype, comp_dtype = precisions[precision]
+    basis = load_weight_basis(
+        prev_idx_map, curr_idx_map, idx_names, kernel_size, w_dtype)
+    w_sum = np.ones(tuple(basis['shape']), dtype=w_dtype)
+    if 'sculp_box' in basis:
+        box = _box_slices(basis['sculp_box'])
+        w_sum[box] += sculp_transp * (basis['seethru'] - basis['sculp'])
+    comp = np.zeros(w_sum.shape + imgs[idx_names[0]].shape[2:], dtype=comp_dtype)
+    for i, idx_name in enumerate(idx_names):
+        if idx_name.startswith('sculp'):
+            scale_a = 1 - sculp_transp
+        else:
+            scale_a = 1.
+        for k, scale in (('a_%d' % i, scale_a), ('b_%d' % i, sculp_transp)):
+            if k not in basis or scale == 0:
+                continue
+            box = _box_slices(basis[k + '_box'])
+            w_map = scale * basis[k] / w_sum[box]
+            _accumulate(comp, box, w_map, imgs[idx_name], offsets.get(idx_name, (0, 0)))
+    return _finish(comp)
+
+
+matting_engines = {
+    'simple': simple_matting,
+    'fused': fused_matting,
+    'band': band_matting,
+    'basis': basis_matting,
+}
+
+
+def estimate_peak_bytes(engine, shape, n_layers, precision='float64'):
+    """
+    Rough peak size of the temporaries that a matting engine allocates for
+    index maps of the given shape, not counting its inputs.
+    """
+    w_dtype, comp_dtype = precisions[precision]
+    w_size = np.dtype(w_dtype).itemsize
+    comp_size = np.dtype(comp_dtype).itemsize
+    per_px = 2 * 8 + 2  # integer index maps and masks
+    if engine == 'simple':
+        # Weight cube, its normalizer and normalized copy, weighted image cube
+        per_px += n_layers * (3 * w_size + 3) + 3 * comp_size
+    else:
+        # Weight sum, weight map and its blur, weighted layer, composite
+        per_px += 3 * w_size + 3 * w_size + 3 * comp_size
+        if engine == 'band':
+            per_px += 3 * 8 + 1  # weight key, its min. and max., band mask
+    return shape[0] * shape[1] * per_px
+
+
+def tiled_matting(matting, imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp,
+                  kernel_size, precision='float64', offsets=None, workers=1, tile_rows=None):
+    """
+    Runs a matting engine on row bands in a thread pool (NumPy and SciPy
+    release the GIL), stitching the bands into one output. Each band is
+    matted with a halo of the Gaussian support, so the result is identical
+    to matting the whole frame at once.
+    """
+    offsets = offsets or {}
+    h = curr_idx_map.shape[0]
+    halo = _kernel_radius(kernel_size)
+    if tile_rows is None:
+        tile_rows = -(-h // workers)
+    img_shape = curr_idx_map.shape + imgs[idx_names[0]].shape[2:]
+    if precision == 'fixed16':
+        comp = np.empty(img_shape, dtype=np.uint8)
+    else:
+        comp = np.empty(img_shape, dtype=precisions[precision][1])
+
+    def run(y0):
+        y1 = min(y0 + tile_rows, h)
+        t0, t1 = max(y0 - halo, 0), min(y1 + halo, h)
+        # Rows of each layer within the tile
+        tile_imgs, tile_offsets = {}, {}
+        for k in idx_names:
+            img = imgs[k]
+            oy, ox = offsets.get(k, (0, 0))
+            r0 = min(max(t0 - oy, 0), img.shape[0])
+            r1 = min(max(t1 - oy, 0), img.shape[0])
+            tile_imgs[k] = img[r0:r1]
+            tile_offsets[k] = (oy + r0 - t0, ox)
+        tile = matting(
+            tile_imgs,
+            prev_idx_map[t0:t1],
+            curr_idx_map[t0:t1],
+            idx_names,
+            sculp_transp,
+            kernel_size,
+            precision=precision,
+            offsets=tile_offsets,
+        )
+        comp[y0:y1] = tile[(y0 - t0):(y1 - t0)]
+
+    tiles = range(0, h, tile_rows)
+    if workers > 1 and len(tiles) > 1:
+        pool = ThreadPool(min(workers, len(tiles)))
+        try:
+            pool.map(run, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for y0 in tiles:
+            run(y0)
     return comp
 
 
-def composite(imgs, fgmask, precomp, sculp_transp, artistic_bg):
-    kernel_size = 1.5 # for simple matting
+def _plan(engine, precision, shape, n_layers, mem_budget):
+    """
+    Requested engine and precision, or the first less memory-hungry fallback
+    that fits in the budget.
+    """
+    if mem_budget is None:
+        return engine, precision
+    modes = ['float64', 'float32', 'fixed16']
+    modes = modes[modes.index(precision):]
+    for e in [engine] + [x for x in ('fused',) if x != engine]:
+        for p in modes:
+            if estimate_peak_bytes(e, shape, n_layers, p) <= mem_budget:
+                if (e, p) != (engine, precision):
+                    print("Falling back to %s matting in %s to stay within %dMB" %
+                          (e, p, mem_budget / (1024 * 1024)))
+                return e, p
+    raise MemoryError(
+        "Compositing %dx%d with %d layers needs more than %dMB" %
+        (shape[0], shape[1], n_layers, mem_budget / (1024 * 1024)))
+
+
+def _run_matting(imgs, prev_idx_map, curr_idx_map, idx_names, sculp_transp, kernel_size,
+                 offsets, engine, precision, mem_budget, workers, tile_rows):
+    h, w = curr_idx_map.shape
+    if workers <= 1 and tile_rows is None:
+        engine, precision = _plan(
+            engine, precision, (h, w), len(idx_names), mem_budget)
+        return matting_engines[engine](
+            imgs,
+            prev_idx_map,
+            curr_idx_map,
+            idx_names,
+            sculp_transp,
+            kernel_size,
+            precision=precision,
+            offsets=offsets,
+        )
+    # Tiled: all workers' tiles, with their halos, share the budget
+    halo = _kernel_radius(kernel_size)
+    rows = min(tile_rows or -(-h // workers), h)
+    if mem_budget is not None:
+        while rows > 2 * halo and min(workers, -(-h // rows)) * estimate_peak_bytes(
+                engine, (rows + 2 * halo, w), len(idx_names), precision) > mem_budget:
+            rows //= 2
+        engine, precision = _plan(
+            engine, precision, (min(rows + 2 * halo, h), w), len(idx_names),
+            mem_budget // min(workers, -(-h // rows)))
+    return tiled_matting(
+        matting_engines[engine],
+        imgs,
+        prev_idx_map,
+        curr_idx_map,
+        idx_names,
+        sculp_transp,
+        kernel_size,
+        precision=precision,
+        offsets=offsets,
+        workers=workers,
+        tile_rows=rows,
+    )
+
+
+def composite(imgs, fgmask, precomp, sculp_transp, artistic_bg, engine=None,
+              precision=None, mem_budget=None, workers=None, tile_rows=None,
+              kernel_size=1.5):
+    # kernel_size is for simple matting, in pixels of the index maps
+    engine = engine or matting_engine
+    precision = precision or comp_precision
+    if mem_budget is None:
+        mem_budget = comp_mem_budget
+    if workers is None:
+        workers = comp_workers
+    if tile_rows is None:
+        tile_rows = comp_tile_rows
 
     prev_idx_map = precomp['prev_idx_map']
     curr_idx_map = precomp['curr_idx_map']
@@ -163,129 +847,355 @@ def composite(imgs, fgmask, precomp, sculp_transp, artistic_bg):
     if artistic_bg:
         # Composite with black, syntheic background
         bg_str = 'bg' # 'bg_bwall'
-        idx_names.append(bg_str)
+        idx_names = idx_names + [bg_str]
         bg_idx = len(idx_names) - 1
         h, w = curr_idx_map.shape
-        # Pad
+        # Place foreground in the middle of the background
         bg = imgs[bg_str]
         if (h, w) != bg.shape[:2]:
-            n_vpad, n_hpad = h, w
-            n_tpad, n_lpad = n_vpad // 2, n_hpad // 2
-            n_bpad, n_rpad = n_vpad - n_tpad, n_hpad - n_lpad
+            n_tpad, n_lpad = h // 2, w // 2
         else:
-            n_tpad = n_bpad = n_lpad = n_rpad = 0
-        imgs_2x = {
-            k: np.pad(v, ((n_tpad, n_bpad),
-                          (n_lpad, n_rpad),
-                          (0, 0)), 'constant', constant_values=0)
-            for k, v in imgs.iteritems() if not k.startswith('bg')
-        }
-        imgs_2x[bg_str] = imgs[bg_str]
-        fgmask_2x = np.pad(fgmask, ((n_tpad, n_bpad), (n_lpad, n_rpad)),
-                           'constant', constant_values=False)
-        curr_idx_map_2x = np.ones(fgmask_2x.shape) * bg_idx
-        curr_idx_map_2x[fgmask_2x] = curr_idx_map[fgmask]
-        prev_idx_map_2x = np.ones(fgmask_2x.shape) * bg_idx
+            n_tpad = n_lpad = 0
+        # Only the foreground window needs matting, plus a margin where its
+        # blurred weights fade out (with a margin of their own to be exact)
+        win = _grow((slice(n_tpad, n_tpad + h), slice(n_lpad, n_lpad + w)),
+                    2 * _kernel_radius(kernel_size), bg.shape)
+        win_shape = (win[0].stop - win[0].start, win[1].stop - win[1].start)
+        fg_offset = (n_tpad - win[0].start, n_lpad - win[1].start)
+        fg_box = (slice(fg_offset[0], fg_offset[0] + h),
+                  slice(fg_offset[1], fg_offset[1] + w))
+        imgs_win = {k: imgs[k] for k in idx_names if k != bg_str}
+        imgs_win[bg_str] = bg[win]
+        offsets = {k: fg_offset for k in imgs_win if k != bg_str}
+        # Index maps of the window
+        dtype = np.promote_types(curr_idx_map.dtype, np.min_scalar_type(bg_idx))
+        curr_idx_map_win = np.full(win_shape, bg_idx, dtype=dtype)
+        curr_idx_map_win[fg_box] = np.where(fgmask, curr_idx_map, bg_idx)
         framenames = sorted(k for k in imgs.keys() if 'sculp' not in k and 'bg' not in k)
-        prev_idx_map[prev_idx_map == idx_names.index(framenames[-1])] = bg_idx
-        prev_idx_map_2x[fgmask_2x] = prev_idx_map[fgmask]
+        last_idx = idx_names.index(framenames[-1])
+        prev_idx_map_win = np.full(win_shape, bg_idx, dtype=dtype)
+        prev_idx_map_win[fg_box] = np.where(
+            np.logical_and(fgmask, prev_idx_map != last_idx), prev_idx_map, bg_idx)
         #
-        comp = simple_matting(
-            imgs_2x,
-            prev_idx_map_2x,
-            curr_idx_map_2x,
+        comp_win = _run_matting(
+            imgs_win,
+            prev_idx_map_win,
+            curr_idx_map_win,
             idx_names,
             sculp_transp,
             kernel_size,
+            offsets,
+            engine,
+            precision,
+            mem_budget,
+            workers,
+            tile_rows,
         )
+        # Background elsewhere
+        comp = bg.astype(comp_win.dtype)
+        comp[win] = comp_win
     else:
         # Composite with the original video
-        comp = simple_matting(
+        comp = _run_matting(
             imgs,
             prev_idx_map,
             curr_idx_map,
             idx_names,
             sculp_transp,
             kernel_size,
+            None,
+            engine,
+            precision,
+            mem_budget,
+            workers,
+            tile_rows,
         )
 
     return comp
 
 
-def get_req_str(req):
-    req_str = ''
-    for k, v in req.iteritems():
-        if isinstance(v, str):
-            req_str += '%s.%s_' % (k, v)
-        elif isinstance(v, list):
-            req_str += '%s.%s_' % (k, '-'.join(sorted(v)))
-        elif isinstance(v, (int, float)):
-            req_str += '%s.%.2f_' % (k, v)
-        elif isinstance(v, dict):
-            req_str += '%s.%s_' % (k, '-'.join(v[x] for x in sorted(req['part'])))
-        else:
-            raise TypeError(v)
-    return req_str[:-1]
+_migrated = []  # whether legacy composite caches have been migrated
 
+# Clip-dependent cropping of composites, as (top, bottom, left, right)
+crops = {
+    'ballet11-2': (50, None, 350, 1160),
+    'olympicRunning_cut': (None, None, 300, 1600),
+}
 
-def main(req, artistic_bg, cache=True):
-    req['part'] = [x.replace(' ', '') for x in req['part']]
-    for k, v in req['mat'].iteritems():
-        if v == 'Original':
-            req['mat'][k] = 'Orig'
 
-    cache_dir = join(tmp_root, req['clip'], 'composite_enum',
-                     get_req_str(req).replace('_', '/'))
-    if artistic_bg:
-        comp_f = join(cache_dir, 'comp_2x.png') # 2x is legacy, just meaning arbitrary size
-    else:
-        comp_f = join(cache_dir, 'comp.png')
+def crop(comp, clip, factor=1):
+    # Of a composite reduced by factor, if any
+    top, bottom, left, right = [
+        None if x is None else x // factor
+        for x in crops.get(clip, (None,) * 4)]
+    return comp[top:bottom, left:right]
 
-    # Results are cached, so directly return
-    if cache and exists(comp_f):
-        print("------ Combination Cached ------")
-        return comp_f
 
-    print("********** Combination New **********")
+def preview_file(tmp_root, req, artistic_bg, factor):
+    return join(tmp_root, 'previews', '%s_%d.png' % (req_hash(req, artistic_bg), factor))
 
+
+def preview(req, artistic_bg, factor=None, size=None):
+    """
+    Quick composite of reduced size, to be shown until the full one is
+    ready: ingredients are decoded reduced by factor, and index maps are
+    strided by it, preview_factor by default. Alternatively, size, as
+    (width, height), e.g., of the viewer, sets the factor to where the
+    composite, fitted into that many pixels, is shown pixel for pixel.
+    Returns the path of the preview, or None if the factor is below 2, as
+    a preview would then take about as long as the composite.
+    """
+    req = normalize(req)
+    if factor is None:
+        factor = preview_factor
+
+    # What the preview uses stays on disk until it is done, as in main()
+    pinned = [join(tmp_root, idxmap_file(req)), archive_path(tmp_root, req['clip'])]
+    disk_cache.pin(pinned)
+    try:
+        precomp = download_load_idxmaps(req, web_root, tmp_root)
+        if size is not None:
+            # Shown fitted into size, keeping the aspect ratio; artistic
+            # composites are on backgrounds twice as large
+            h, w = precomp['is_fg'].shape
+            if artistic_bg:
+                h, w = 2 * h, 2 * w
+            h, w = crop(np.broadcast_to(False, (h, w)), req['clip']).shape
+            fit = max(float(h) / max(size[1], 1), float(w) / max(size[0], 1))
+            factor = int(np.ceil(fit))
+        if factor < 2:
+            return None
+
+        preview_f = preview_file(tmp_root, req, artistic_bg, factor)
+        if disk_cache.contains(preview_f):
+            disk_cache.hold('preview', [preview_f])
+            return preview_f
+
+        t0 = time()
+        ingredients = [join(tmp_root, f) for _, f in list_ingredients(req, precomp)]
+        disk_cache.pin(ingredients)
+        pinned += ingredients
+        precomp_reduced = {'idx_names': precomp['idx_names']}
+        for k in ('curr_idx_map', 'prev_idx_map', 'is_fg'):
+            precomp_reduced[k] = np.ascontiguousarray(precomp[k][::factor, ::factor])
+        imgs = download_load_imgs(req, precomp, web_root, tmp_root, factor=factor)
+        imgs = combine_shadow(imgs, comp_precision)
+        comp = composite(imgs, precomp_reduced['is_fg'], precomp_reduced, req['transp'],
+                         artistic_bg, kernel_size=1.5 / factor)
+        comp = crop(comp, req['clip'], factor)
+
+        disk_cache.ensure_dirs([dirname(preview_f)])
+        fd, tmp_f = mkstemp(dir=dirname(preview_f))
+        with fdopen(fd, 'wb') as h:
+            Image.fromarray(comp.astype(np.uint8)).save(h, format='PNG')
+        rename(tmp_f, preview_f)  # so that no one reads a partial file
+        disk_cache.add(preview_f)
+        disk_cache.hold('preview', [preview_f])  # until the caller has read it
+    finally:
+        disk_cache.unpin(pinned)
+    print("Preview at 1/%d in %fs" % (factor, time() - t0))
+    return preview_f
+
+
+codec = get_codec(result_codec)  # of the composite cache
+
+
+def cached_file(req, artistic_bg):
+    """
+    Cached composite of a normalized request, in the format of the cache or
+    else in any other, e.g., from before it was changed; None if there is
+    none.
+    """
+    exts = [codec.ext] + sorted(set(c.ext for c in codecs.itervalues()) - set([codec.ext]))
+    for ext in exts:
+        comp_f = comp_file(tmp_root, req, artistic_bg, ext)
+        if disk_cache.contains(comp_f) or comp_writer.pending(comp_f) is not None:
+            return comp_f
+    return None
+
+
+def is_cached(req, artistic_bg):
+    """
+    Whether main() would return the composite of req from the cache.
+    """
+    return cached_file(normalize(req), artistic_bg) is not None
+
+
+def load_ingredients(req, pinned=None):
+    """
+    Index maps and image ingredients of a normalized request, downloaded
+    if need be, with backgrounds combined with shadow. Ingredients are
+    pinned on disk and appended to pinned, if given, for the caller to
+    unpin.
+    """
     # Download and then load the precomputed index maps
     print("* Downloading precomputed index maps...")
     t0 = time()
     precomp = download_load_idxmaps(req, web_root, tmp_root)
     print("Done in %fs" % (time() - t0))
+    if pinned is not None:
+        ingredients = [join(tmp_root, f) for _, f in list_ingredients(req, precomp)]
+        disk_cache.pin(ingredients)
+        pinned += ingredients
 
     # Download and then load image ingredients
     print("* Downloading image ingradients...")
     t0 = time()
-    imgs = download_load_imgs(req, precomp, web_root, tmp_root)
+    imgs = download_load_imgs(req, precomp, web_root, tmp_root,
+                              skip_bgs=shadow_bgs.cached_parts(req, comp_precision))
     print("Done in %fs" % (time() - t0))
+    print("Decoded images cached: %(hits)d hits, %(misses)d misses, "
+          "%(evictions)d evictions, %(images)d images in %(bytes)dB" %
+          decoded_imgs.stats())
 
     # Combine backgrounds
     print("* Combining backgrounds with shadow...")
     t0 = time()
-    imgs = combine_shadow(imgs)
+    imgs = shadow_bgs.combine(req, imgs, comp_precision)
     print("Done in %fs" % (time() - t0))
+    return precomp, imgs
 
-    # Composite
+
+def render(req, artistic_bg, precomp, imgs, workers=None):
+    """
+    Cropped composite of a normalized request from its ingredients.
+    """
     print("* Compositing...")
     t0 = time()
-    comp = composite(imgs, precomp['is_fg'], precomp, req['transp'], artistic_bg)
+    comp = composite(imgs, precomp['is_fg'], precomp, req['transp'], artistic_bg,
+                     workers=workers)
     print("Done in %fs" % (time() - t0))
 
-    print("*************************************")
-
     # Clip-dependent cropping
-    if req['clip'] == 'ballet11-2':
-        comp = comp[50:, 350:1160, :]
-    elif req['clip'] == 'olympicRunning_cut':
-        comp = comp[:, 300:1600, :]
+    return crop(comp, req['clip'])
+
+
+def save_comp(comp, comp_f):
+    disk_cache.ensure_dirs([dirname(comp_f)])
+    fd, tmp_f = mkstemp(dir=dirname(comp_f))
+    with fdopen(fd, 'wb') as h:
+        codec_of(comp_f).encode(comp.astype(np.uint8), h)
+    rename(tmp_f, comp_f)  # so that no one reads a partial file
+    disk_cache.add(comp_f)
+
+
+class CompositeWriter(object):
+    """
+    Saves composites on a background thread, so that they can be shown
+    before they are encoded. Those not saved yet are served from memory.
+    """
 
-    # Write to disk
-    if not exists(cache_dir):
-        makedirs(cache_dir)
-    Image.fromarray(comp.astype(np.uint8)).save(comp_f)
+    def __init__(self):
+        self._pending = OrderedDict()  # path -> composite, oldest first
+        self._cond = Condition()
+        self._thread = None
 
-    return comp_f
+    def save(self, comp, comp_f):
+        with self._cond:
+            self._pending[comp_f] = comp
+            self._cond.notify_all()
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def pending(self, comp_f):
+        with self._cond:
+            return self._pending.get(comp_f)
+
+    def flush(self):
+        """
+        Waits until all composites are saved.
+        """
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                comp_f, comp = next(self._pending.iteritems())
+            try:
+                save_comp(comp, comp_f)
+            except (IOError, OSError) as e:
+                print("Failed to save %s: %s" % (comp_f, e))
+            with self._cond:
+                # Unless given again meanwhile
+                if self._pending.get(comp_f) is comp:
+                    del self._pending[comp_f]
+                self._cond.notify_all()
+
+
+comp_writer = CompositeWriter()
+atexit.register(comp_writer.flush)
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+def main(req, artistic_bg, cache=True, cancelled=None, array=False):
+    """
+    Composite of req, from the cache if there, as the path of its file,
+    which codec_of() decodes, or, if array, as an 8-bit array, whose file is
+    then saved in the background.
+    If cancelled() turns true by the time the ingredients are loaded,
+    RenderCancelled is raised instead of compositing.
+    """
+    if not _migrated:
+        migrate(tmp_root)
+        _migrated.append(True)
+    req = normalize(req)
+
+    comp_f = comp_file(tmp_root, req, artistic_bg, codec.ext)
+
+    # Results are cached, so directly return
+    cached_f = cached_file(req, artistic_bg) if cache else None
+    if cached_f is not None:
+        print("------ Combination Cached ------")
+        comp = comp_writer.pending(cached_f)
+        if comp is not None:
+            if array:
+                return comp
+            comp_writer.flush()
+        if disk_cache.contains(cached_f):  # unless saving failed
+            disk_cache.touch([cached_f])
+            if not array:
+                disk_cache.hold('result', [cached_f])
+                return cached_f
+            try:
+                return codec_of(cached_f).decode(cached_f)
+            except (IOError, OSError):
+                # Indexed, but removed meanwhile, e.g., by another process,
+                # so rendered again
+                disk_cache.forget(cached_f)
+
+    print("********** Combination New **********")
+
+    # What this request uses stays on disk until it is done
+    pinned = [comp_f, join(tmp_root, idxmap_file(req)), archive_path(tmp_root, req['clip'])]
+    disk_cache.pin(pinned)
+    try:
+        precomp, imgs = load_ingredients(req, pinned)
+        if cancelled is not None and cancelled():
+            raise RenderCancelled
+        comp = render(req, artistic_bg, precomp, imgs).astype(np.uint8)
+        print("*************************************")
+
+        # Write to disk
+        if array:
+            comp_writer.save(comp, comp_f)
+        else:
+            save_comp(comp, comp_f)
+        disk_cache.touch(pinned)
+    finally:
+        disk_cache.unpin(pinned)
+    if not array:
+        disk_cache.hold('result', [comp_f])  # until the caller has read it
+    disk_cache.evict()
+    return comp if array else comp_f
 
 
 if __name__ == '__main__':
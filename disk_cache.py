@@ -0,0 +1,435 @@
+"""
+Disk cache of tmp_root. Clicks on a cached composite can be timed with the
+index and with presence checked on disk, as before it, with, e.g.,
+
+    python disk_cache.py --delay 2
+"""
+
+import os
+import sys
+import json
+import atexit
+from argparse import ArgumentParser
+from os import walk, remove, stat, fdopen, rename, makedirs
+from os.path import join, exists, isdir, relpath, getsize, dirname
+from collections import OrderedDict
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp, template
+from threading import RLock
+from time import sleep, time
+import numpy as np
+from app_config import tmp_root, disk_cache_bytes
+
+
+# Entries of version 1 indexes predate downloads through .part files
+INDEX_VERSION = 2
+
+
+def _source(rel):
+    # Derived entries (raw transcodes, compact index maps) go with their source
+    if rel.endswith('.raw'):
+        return rel[:-len('.raw')]
+    if rel.endswith('.idxmap'):
+        return rel[:-len('.idxmap')] + '.npz'
+    return rel
+
+
+def _derived(rel):
+    # An entry and those derived from it
+    derived = [rel, rel + '.raw']
+    if rel.endswith('.npz'):
+        derived.append(rel[:-len('.npz')] + '.idxmap')
+    return derived
+
+
+def _transient(name):
+    # Partial downloads, and files or directories being written, which are
+    # renamed into place when complete
+    return name.endswith('.part') or name.startswith(template)
+
+
+def _size(path):
+    if not isdir(path):
+        return getsize(path)
+    return sum(getsize(join(d, f)) for d, _, fs in walk(path) for f in fs)
+
+
+class DiskCache(object):
+    """
+    Keeps the files under root within a byte budget, evicting the least
+    recently used ones. Entries, with their sizes and access times, are
+    tracked in an index saved under root, so that eviction needs no walk
+    of the tree. The index, checked against one walk on first use, also
+    answers which entries and directories exist without calls to disk.
+    Entries not written through it, i.e., found by the walk or indexed
+    before downloads were written to .part files first, may be truncated,
+    and are unverified until checked, as Fetcher.fetch() does.
+    Pinned entries, e.g., those in use by the current request, are never
+    evicted; unpinned ones may be memory-mapped still, which removal does
+    not disturb.
+    """
+
+    index_name = '.cache_index.json'
+    save_interval = 10  # seconds between saves of the index on access
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = None  # relative path -> (size, access time), oldest first
+        self._dirs = set()
+        self._unverified = set()
+        self._pins = {}
+        self._held = {}
+        self._lock = RLock()
+        self._saved = 0
+
+    def _rel(self, path):
+        rel = relpath(path, self.root)
+        return None if rel.startswith('..') else rel
+
+    def _load(self):
+        # Index from disk, reconciled with one walk of the tree, which also
+        # finds the directories there
+        if self._entries is not None:
+            return
+        indexed = {}
+        verified = set()
+        try:
+            with open(join(self.root, self.index_name)) as h:
+                index = json.load(h)
+            if index.get('version') in (1, INDEX_VERSION):
+                for rel, size, atime in index['entries']:
+                    indexed[rel] = (size, atime)
+            if index.get('version') == INDEX_VERSION:
+                verified = set(indexed) - set(index['unverified'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        stamped = []
+        for rel in self._scan():
+            if rel in indexed:
+                size, atime = indexed[rel]
+            else:
+                path = join(self.root, rel)
+                try:
+                    st = stat(path)
+                    size, atime = _size(path), max(st.st_atime, st.st_mtime)
+                except OSError:  # removed meanwhile
+                    continue
+            stamped.append((atime, rel, size))
+        self._entries = OrderedDict()
+        for atime, rel, size in sorted(stamped):
+            self._entries[rel] = (size, atime)
+        self._unverified = set(self._entries) - verified
+        self.nbytes = sum(size for size, _ in self._entries.itervalues())
+
+    def _scan(self):
+        # Entries under root, recording the directories on the way
+        entries = []
+        self._dirs = set()
+        for d, dirs, fs in walk(self.root):
+            self._dirs.add(relpath(d, self.root))
+            for x in [x for x in dirs if x.endswith('.idxmap') or _transient(x)]:
+                dirs.remove(x)
+                if not _transient(x):
+                    entries.append(relpath(join(d, x), self.root))
+            entries += [relpath(join(d, f), self.root) for f in fs
+                        if f != self.index_name and not _transient(f)]
+        return entries
+
+    def contains(self, path):
+        """
+        Whether there is an entry at path, answered from memory for paths
+        under root. Entries removed by other processes show until readers,
+        failing to open them, forget() them.
+        """
+        rel = self._rel(path)
+        if rel is None:
+            return exists(path)
+        with self._lock:
+            self._load()
+            return rel in self._entries
+
+    def ensure_dirs(self, dirs):
+        """
+        Makes those of dirs that are missing, with no calls for those known.
+        """
+        with self._lock:
+            self._load()
+            todo = set(d for d in dirs if self._rel(d) not in self._dirs)
+        for d in sorted(todo):
+            try:
+                makedirs(d)
+            except OSError:  # made meanwhile
+                pass
+        with self._lock:
+            for d in todo:
+                rel = self._rel(d)
+                while rel is not None and rel not in self._dirs:
+                    self._dirs.add(rel)
+                    rel = (dirname(rel) or '.') if rel != '.' else None
+
+    def add(self, path):
+        """
+        Records a new or rewritten entry at path.
+        """
+        rel = self._rel(path)
+        if rel is None:
+            return
+        size = _size(path)
+        with self._lock:
+            self._load()
+            old = self._entries.pop(rel, None)
+            if old is not None:
+                self.nbytes -= old[0]
+            self._entries[rel] = (size, time())
+            self._unverified.discard(rel)
+            self.nbytes += size
+            self._maybe_save()
+
+    def forget(self, path):
+        """
+        Stops tracking the entry at path, e.g., when it is moved away, or
+        found missing, as when another process removed it. Its directories
+        are checked on disk again by ensure_dirs(), as they may be gone too.
+        """
+        rel = self._rel(path)
+        if rel is None:
+            return
+        with self._lock:
+            self._load()
+            old = self._entries.pop(rel, None)
+            if old is not None:
+                self.nbytes -= old[0]
+            self._unverified.discard(rel)
+            d = dirname(rel)
+            while d:
+                self._dirs.discard(d)
+                d = dirname(d)
+
+    def verified(self, path):
+        """
+        Whether the entry at path is known to be complete, as those written
+        through the cache are; always true for paths outside root.
+        """
+        rel = self._rel(path)
+        if rel is None:
+            return True
+        with self._lock:
+            self._load()
+            return rel not in self._unverified
+
+    def verify(self, path):
+        """
+        Marks the entry at path as checked to be complete.
+        """
+        with self._lock:
+            self._load()
+            self._unverified.discard(self._rel(path))
+
+    def touch(self, paths):
+        """
+        Marks entries at paths, and those derived from them, as just used.
+        """
+        now = time()
+        with self._lock:
+            self._load()
+            for p in paths:
+                rel = self._rel(p)
+                if rel is None:
+                    continue
+                for x in _derived(rel):
+                    if x in self._entries:
+                        size, _ = self._entries.pop(x)
+                        self._entries[x] = (size, now)
+            self._maybe_save()
+
+    def changed_since(self, t):
+        """
+        Paths of entries added or used since time t, e.g., for the parent
+        of a worker process to add to its own index.
+        """
+        with self._lock:
+            self._load()
+            return [join(self.root, rel) for rel, (_, atime) in self._entries.iteritems()
+                    if atime >= t]
+
+    def pin(self, paths):
+        with self._lock:
+            for p in paths:
+                rel = self._rel(p)
+                self._pins[rel] = self._pins.get(rel, 0) + 1
+
+    def unpin(self, paths):
+        with self._lock:
+            for p in paths:
+                rel = self._rel(p)
+                self._pins[rel] -= 1
+                if self._pins[rel] == 0:
+                    del self._pins[rel]
+
+    def hold(self, name, paths):
+        """
+        Pins paths in place of those last held under name, e.g., a result
+        that the caller reads after it is returned.
+        """
+        with self._lock:
+            self.unpin(self._held.pop(name, []))
+            self.pin(paths)
+            self._held[name] = paths
+
+    def evict(self):
+        """
+        Removes least recently used, unpinned entries until within budget.
+        """
+        with self._lock:
+            self._load()
+            if self.nbytes <= self.max_bytes:
+                return
+            t0 = time()
+            n_entries, n_bytes = 0, 0
+            for rel, (size, _) in list(self._entries.iteritems()):
+                if self.nbytes <= self.max_bytes:
+                    break
+                if _source(rel) in self._pins or rel in self._pins:
+                    continue
+                path = join(self.root, rel)
+                try:
+                    if isdir(path):
+                        rmtree(path)
+                    else:
+                        remove(path)
+                except OSError:  # removed already
+                    pass
+                del self._entries[rel]
+                self._unverified.discard(rel)
+                self.nbytes -= size
+                n_entries += 1
+                n_bytes += size
+            self.save()
+            print("Disk cache: evicted %d entries, %dB in %fs; %dB of %dB used" % (
+                n_entries, n_bytes, time() - t0, self.nbytes, self.max_bytes))
+
+    def _maybe_save(self):
+        if time() - self._saved > self.save_interval:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            if self._entries is None:
+                return
+            index = {
+                'version': INDEX_VERSION,
+                'entries': [[rel, size, atime]
+                            for rel, (size, atime) in self._entries.iteritems()],
+                'unverified': sorted(self._unverified),
+            }
+            if not exists(self.root):
+                makedirs(self.root)
+            fd, tmp_f = mkstemp(dir=self.root)
+            with fdopen(fd, 'w') as h:
+                json.dump(index, h)
+            rename(tmp_f, join(self.root, self.index_name))
+            self._saved = time()
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'pinned': len(self._pins),
+            }
+
+
+disk_cache = DiskCache(tmp_root, disk_cache_bytes)
+atexit.register(disk_cache.save)
+
+
+class _DiskLookups(DiskCache):
+    # As before the index: presence is checked on disk
+    def contains(self, path):
+        return exists(path)
+
+
+def benchmark(req, artistic_bg=False, clicks=100, n_entries=10000, delay=0.):
+    """
+    Time of a click on the cached composite of req, as the render worker
+    makes it, i.e., is_cached() and then main(), in a throwaway cache of
+    n_entries besides: with presence checked on disk, as before the index,
+    and from the index. Times are averaged over clicks, with each stat()
+    slowed by delay seconds, e.g., as on networked home directories.
+    """
+    import composite_online  # which imports this module
+    root = mkdtemp()
+    saved = composite_online.tmp_root, composite_online.disk_cache
+    real_stat, devnull, stdout = os.stat, open(os.devnull, 'w'), sys.stdout
+    n_stats = [0]
+
+    def slow_stat(path):
+        n_stats[0] += 1
+        if delay > 0:
+            sleep(delay)
+        return real_stat(path)
+
+    try:
+        composite_online.tmp_root = root
+        for i in range(n_entries):
+            d = join(root, 'clip%d' % (i % 10))
+            if not exists(d):
+                makedirs(d)
+            with open(join(d, '%016x.jpg' % i), 'wb') as h:
+                h.write('x')
+        composite_online.disk_cache = DiskCache(root, 1 << 40)
+        comp = np.random.RandomState(0).randint(0, 256, (720, 1280, 3)).astype(np.uint8)
+        composite_online.save_comp(comp, composite_online.comp_file(
+            root, composite_online.normalize(req), artistic_bg, composite_online.codec.ext))
+        results = {}
+        for name, cache in (('disk', _DiskLookups(root, 1 << 40)),
+                            ('index', DiskCache(root, 1 << 40))):
+            composite_online.disk_cache = cache
+            sys.stdout = devnull
+            cache.save()  # loads the index, and is not due again while timed
+            composite_online.main(req, artistic_bg, array=True)
+            os.stat = slow_stat
+            n_stats[0] = 0
+            t0 = time()
+            for _ in range(clicks):
+                assert composite_online.is_cached(req, artistic_bg)
+                composite_online.main(req, artistic_bg, array=True)
+            t = (time() - t0) / clicks
+            os.stat, sys.stdout = real_stat, stdout
+            results[name] = {'click': t, 'stats': n_stats[0] / float(clicks)}
+            print("%-6s %7.2fms per click, %.1f stat() calls" % (
+                name, 1e3 * t, n_stats[0] / float(clicks)))
+        return results
+    finally:
+        os.stat, sys.stdout = real_stat, stdout
+        composite_online.tmp_root, composite_online.disk_cache = saved
+        rmtree(root)
+
+
+def main():
+    parser = ArgumentParser(description="Time clicks on a cached composite, with and "
+                                        "without the index")
+    parser.add_argument('-c', '--clicks', type=int, default=100)
+    parser.add_argument('-n', '--entries', type=int, default=10000,
+                        help="other files in the cache")
+    parser.add_argument('-d', '--delay', type=float, default=0.,
+                        help="milliseconds added to each stat()")
+    args = parser.parse_args()
+    req = {
+        'clip': 'ballet11-2',
+        'density': 0,
+        'lights': ['Left', 'Middle', 'Right'],
+        'transp': 0,
+        'spec': True,
+        'part': ['Body'],
+        'mat': {'Body': 'Leather'},
+    }
+    benchmark(req, clicks=args.clicks, n_entries=args.entries, delay=args.delay / 1e3)
+
+
+if __name__ == '__main__':
+    main()
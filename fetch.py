@@ -0,0 +1,268 @@
+from os import remove, rename, getpid
+from os.path import join, exists, dirname, getsize
+from socket import error as SocketError
+from threading import Lock, local
+from multiprocessing.pool import ThreadPool
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from urlparse import urlsplit
+from urllib import quote
+from time import time
+from app_config import fetch_workers, fetch_timeout, fetch_retries
+from disk_cache import disk_cache
+
+
+class FileNotOnServerException(Exception):
+    pass
+
+
+class IncompleteDownload(IOError):
+    pass
+
+
+def _range_start(resp):
+    # Content-Range: bytes <start>-<end>/<total>
+    content_range = resp.getheader('content-range', '')
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _range_total(resp):
+    # Content-Range: bytes */<total>, of 416 responses
+    content_range = resp.getheader('content-range', '')
+    try:
+        return int(content_range.split('/')[1])
+    except (IndexError, ValueError):
+        return None
+
+
+class Fetcher(object):
+    """
+    Downloads files under one web root on a pool of threads, each keeping
+    its own persistent HTTP/1.1 connection. A file is written to a .part file
+    next to it, and renamed into place only once complete, so an existing
+    file is never truncated; interrupted downloads resume from their .part
+    file with Range requests.
+    """
+
+    chunk_size = 1 << 16
+
+    def __init__(self, web_root, workers=fetch_workers, timeout=fetch_timeout,
+                 retries=fetch_retries):
+        parts = urlsplit(web_root)
+        self.web_root = web_root
+        self.host = parts.netloc
+        self.path = parts.path.rstrip('/')
+        self.conn_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+        self.timeout = timeout
+        self.workers = workers
+        self.retries = retries
+        self._pool = None
+        self._pool_lock = Lock()
+        self._local = local()
+        self._file_locks = {}
+        self._file_locks_lock = Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.conn_class(self.host, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _drop_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _lock_file(self, local_f):
+        # Only one thread may write a given .part file; locks are kept only
+        # while some thread needs them
+        with self._file_locks_lock:
+            lock, n_users = self._file_locks.get(local_f, (None, 0))
+            self._file_locks[local_f] = (lock or Lock(), n_users + 1)
+            lock = self._file_locks[local_f][0]
+        lock.acquire()
+
+    def _unlock_file(self, local_f):
+        with self._file_locks_lock:
+            lock, n_users = self._file_locks.pop(local_f)
+            if n_users > 1:
+                self._file_locks[local_f] = (lock, n_users - 1)
+        lock.release()
+
+    def _get(self, f, headers=None, method='GET'):
+        url_path = quote(self.path + '/' + f)
+        # A kept-alive connection may have been closed by the server
+        # meanwhile, so retry once on a fresh one
+        for attempt in (0, 1):
+            try:
+                conn = self._conn()
+                conn.request(method, url_path, headers=headers or {})
+                return conn.getresponse()
+            except (HTTPException, SocketError):
+                self._drop_conn()
+                if attempt:
+                    raise
+
+    def open(self, f):
+        """
+        Response for f, relative to the web root, to be read to the end,
+        or closed with drop_conn, before the calling thread fetches again.
+        """
+        resp = self._get(f)
+        if resp.status != 200:
+            resp.read()
+            raise FileNotOnServerException(self.web_root + '/' + f)
+        return resp
+
+    def drop_conn(self):
+        self._drop_conn()
+
+    def fetch(self, f, local_f, report_hook=None):
+        """
+        Downloads f, relative to the web root, to local_f unless that exists,
+        complete. Returns the number of bytes downloaded. report_hook is
+        called as urllib's is.
+        """
+        if disk_cache.contains(local_f) and disk_cache.verified(local_f):
+            return 0
+        self._lock_file(local_f)
+        try:
+            return self._fetch(f, local_f, report_hook)
+        finally:
+            self._unlock_file(local_f)
+
+    def _fetch(self, f, local_f, report_hook):
+        if disk_cache.contains(local_f):
+            if disk_cache.verified(local_f):  # downloaded by another thread meanwhile
+                return 0
+            # From before downloads went through .part files, so possibly
+            # truncated: checked once against the server
+            complete = self._complete(f, local_f)
+            if complete:
+                disk_cache.verify(local_f)
+            if complete is not False:
+                return 0  # if unknown, used as is, and checked again later
+            disk_cache.forget(local_f)
+        disk_cache.ensure_dirs([dirname(local_f)])
+        part_f = local_f + '.part'
+        n_bytes = [0]  # by all attempts, including failed ones
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch_part(f, part_f, report_hook, n_bytes)
+                break
+            except (HTTPException, SocketError, IncompleteDownload):
+                self._drop_conn()
+                if attempt == self.retries:
+                    raise
+        rename(part_f, local_f)
+        disk_cache.add(local_f)
+        return n_bytes[0]
+
+    def _complete(self, f, local_f):
+        # Whether local_f is as long as f on the server, true also if f is
+        # not there to compare with; None if the server is out of reach
+        try:
+            resp = self._get(f, method='HEAD')
+            resp.read()
+        except (HTTPException, SocketError):
+            self._drop_conn()
+            return None
+        length = resp.getheader('content-length')
+        if resp.status != 200 or length is None:
+            return True
+        try:
+            return int(length) == getsize(local_f)
+        except OSError:  # removed meanwhile
+            return False
+
+    def _fetch_part(self, f, part_f, report_hook, n_bytes):
+        # Downloads the rest of f into part_f, resuming from where it ends,
+        # adding the bytes received to n_bytes[0] as they come
+        offset = getsize(part_f) if exists(part_f) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else None
+        resp = self._get(f, headers)
+        if resp.status == 206 and _range_start(resp) == offset:
+            mode = 'ab'
+        elif resp.status == 200:
+            offset, mode = 0, 'wb'
+        elif resp.status == 416:
+            resp.read()
+            if _range_total(resp) == offset:
+                return  # part_f is complete already, e.g., if not renamed before
+            # Otherwise, part_f is not a prefix of f
+            remove(part_f)
+            raise IncompleteDownload("%s: stale partial download" % f)
+        else:
+            resp.read()  # drain, so that the connection can be reused
+            raise FileNotOnServerException(self.web_root + '/' + f)
+        length = resp.getheader('content-length')
+        if length is None and not resp.chunked:
+            # Ended by closing the connection, so an early end would pass
+            raise IncompleteDownload("%s: no length given" % f)
+        total = offset + int(length) if length is not None else -1
+        if report_hook is not None:
+            report_hook(0, self.chunk_size, total)
+        size = offset
+        with open(part_f, mode) as h:
+            while True:
+                chunk = resp.read(self.chunk_size)
+                if not chunk:
+                    break
+                h.write(chunk)
+                size += len(chunk)
+                n_bytes[0] += len(chunk)
+                if report_hook is not None:
+                    report_hook(1, size, total)
+        if total >= 0 and size != total:
+            raise IncompleteDownload("%s: got %d of %d bytes" % (f, size, total))
+
+    def fetch_all(self, fs, local_root):
+        """
+        Downloads all of fs, relative to the web root, to the same paths
+        under local_root. Returns download statistics.
+        """
+        t0 = time()
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        disk_cache.ensure_dirs(set(dirname(join(local_root, f)) for f in fs))
+        n_bytes = self._pool.map(
+            lambda f: self.fetch(f, join(local_root, f)), fs)
+        stats = {
+            'files': len(fs),
+            'fetched': sum(1 for n in n_bytes if n > 0),
+            'bytes': sum(n_bytes),
+            'seconds': time() - t0,
+        }
+        stats['rate'] = stats['bytes'] / max(stats['seconds'], 1e-6)
+        return stats
+
+
+_fetchers = {}
+_fetchers_lock = Lock()
+
+
+def get_fetcher(web_root):
+    """
+    Fetcher shared by all callers for web_root, so that its connections are
+    kept across requests. Forked processes get their own, as the threads
+    and connections of their parent's are not theirs.
+    """
+    key = (web_root, getpid())
+    with _fetchers_lock:
+        if key not in _fetchers:
+            _fetchers[key] = Fetcher(web_root)
+        return _fetchers[key]
+
+
+def retrieve(url, local_f, report_hook=None):
+    """
+    Downloads url to local_f unless that exists, as Fetcher.fetch does.
+    """
+    parts = urlsplit(url)
+    web_root = '%s://%s' % (parts.scheme, parts.netloc)
+    return get_fetcher(web_root).fetch(parts.path.lstrip('/'), local_f, report_hook)
@@ -0,0 +1,181 @@
+import json
+from os import rename, stat
+from os.path import dirname, join
+from collections import OrderedDict
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+import numpy as np
+from app_config import idxmap_cache_size, idxmap_compact
+from disk_cache import disk_cache
+
+
+# Version of the compact layout: a directory of uncompressed, memory-mappable
+# arrays with the smallest label type, is_fg packed to bits
+COMPACT_VERSION = 1
+
+
+def _stamp(path):
+    # Compact copies are stale once their source changes
+    st = stat(path)
+    return [st.st_size, repr(st.st_mtime)]
+
+
+def compact_path(npz_f):
+    return npz_f[:-len('.npz')] + '.idxmap'
+
+
+def load_npz(npz_f):
+    precomp = dict(np.load(npz_f))
+    precomp['idx_names'] = list(precomp['idx_names'])
+    return precomp
+
+
+def compact_arrays(precomp):
+    """
+    Arrays, by file name, and metadata of the compact layout of index maps.
+    """
+    n_labels = len(precomp['idx_names'])
+    label_dtype = np.uint8 if n_labels <= 256 else np.uint16
+    arrays = {}
+    for k in ('curr_idx_map', 'prev_idx_map'):
+        x = precomp[k]
+        assert x.min() >= 0 and x.max() < n_labels, "%s out of range" % k
+        arrays[k + '.npy'] = x.astype(label_dtype)
+    arrays['is_fg.npy'] = np.packbits(precomp['is_fg'])
+    meta = {
+        'version': COMPACT_VERSION,
+        'idx_names': precomp['idx_names'],
+        'shape': precomp['is_fg'].shape,
+    }
+    return arrays, meta
+
+
+def from_compact(meta, load_array):
+    """
+    Index maps from the compact layout, given its metadata and a function
+    loading its arrays by file name.
+    """
+    h, w = meta['shape']
+    is_fg = np.unpackbits(load_array('is_fg.npy'))[:(h * w)]
+    return {
+        'idx_names': [str(x) for x in meta['idx_names']],
+        'curr_idx_map': load_array('curr_idx_map.npy'),
+        'prev_idx_map': load_array('prev_idx_map.npy'),
+        'is_fg': is_fg.reshape((h, w)).astype(bool),
+    }
+
+
+def convert(npz_f):
+    """
+    Writes the compact copy of an index map file, replacing any stale one.
+    Another process converting the same file meanwhile wins.
+    """
+    arrays, meta = compact_arrays(load_npz(npz_f))
+    meta['stamp'] = _stamp(npz_f)
+    tmp_dir = mkdtemp(dir=dirname(npz_f))
+    for k, x in arrays.iteritems():
+        np.save(join(tmp_dir, k), x)
+    with open(join(tmp_dir, 'meta.json'), 'w') as h:
+        json.dump(meta, h)
+    out_dir = compact_path(npz_f)
+    for attempt in range(3):
+        try:
+            rename(tmp_dir, out_dir)
+            break
+        except OSError:
+            if load_compact(npz_f) is not None:  # converted meanwhile
+                rmtree(tmp_dir)
+                break
+            if attempt == 2:
+                rmtree(tmp_dir)
+                raise
+            rmtree(out_dir, ignore_errors=True)  # stale, or partly removed
+    disk_cache.add(out_dir)
+
+
+def load_compact(npz_f):
+    """
+    Index maps from the compact copy of npz_f, or None if that is missing,
+    of another version, or stale.
+    """
+    in_dir = compact_path(npz_f)
+    try:
+        with open(join(in_dir, 'meta.json')) as h:
+            meta = json.load(h)
+        stamp = _stamp(npz_f)
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('version') != COMPACT_VERSION or meta['stamp'] != stamp:
+        return None
+    return from_compact(meta, lambda k: np.load(join(in_dir, k), mmap_mode='r'))
+
+
+def load_archived(archive, name):
+    """
+    Index maps of member name of a clip archive, from its compact copy in
+    the archive if there is one.
+    """
+    compact_dir = compact_path(name)
+    meta_name = compact_dir + '/meta.json'
+    if meta_name in archive:
+        meta = json.loads(archive.read(meta_name))
+        if meta.get('version') == COMPACT_VERSION:
+            return from_compact(meta, lambda k: archive.array(compact_dir + '/' + k))
+    return load_npz(archive.open(name))
+
+
+class IdxMapCache(object):
+    """
+    Parsed index maps keyed by path, keeping the most recently used ones.
+    With compact, each file is converted once to the compact layout, and
+    loaded from there, memory-mapped, from then on; clip archives carry
+    that layout already.
+    """
+
+    def __init__(self, max_items, compact=False):
+        self.max_items = max_items
+        self.compact = compact
+        self._maps = OrderedDict()
+        self._lock = Lock()
+        self._convert_lock = Lock()
+
+    def load(self, npz_f, archive=None):
+        """
+        Index maps of npz_f, or of member npz_f of archive if given.
+        """
+        key = npz_f if archive is None else (archive.path, npz_f)
+        with self._lock:
+            precomp = self._maps.pop(key, None)
+            if precomp is not None:
+                self._maps[key] = precomp  # most recently used
+        if precomp is None:
+            if archive is None:
+                precomp = self._load(npz_f)
+            else:
+                precomp = load_archived(archive, npz_f)
+            with self._lock:
+                self._maps[key] = precomp
+                while len(self._maps) > self.max_items:
+                    self._maps.popitem(last=False)
+        # Shared, so callers get their own dict and name list
+        precomp = dict(precomp)
+        precomp['idx_names'] = list(precomp['idx_names'])
+        return precomp
+
+    def _load(self, npz_f):
+        if not self.compact:
+            return load_npz(npz_f)
+        precomp = load_compact(npz_f)
+        if precomp is None:
+            # One conversion at a time, e.g., of the prefetching and
+            # rendering threads
+            with self._convert_lock:
+                precomp = load_compact(npz_f)  # converted meanwhile
+                if precomp is None:
+                    convert(npz_f)
+                    precomp = load_compact(npz_f)
+        return precomp
+
+
+idxmaps = IdxMapCache(idxmap_cache_size, idxmap_compact)
@@ -0,0 +1,161 @@
+import json
+from os import stat, fdopen, rename
+from os.path import dirname
+from collections import OrderedDict
+from tempfile import mkstemp
+from threading import Lock
+import numpy as np
+from PIL import Image
+from app_config import img_cache_bytes, raw_img_store
+from disk_cache import disk_cache
+
+
+# Raw transcodes are this header, padded to its size, followed by the pixels
+RAW_MAGIC = 'mosculp-raw'
+RAW_VERSION = 1
+RAW_HEADER_SIZE = 256
+
+
+def _raw_stamp(path):
+    # Raw transcodes are stale once their source changes
+    st = stat(path)
+    return st.st_size, repr(st.st_mtime)
+
+
+def load_raw(path):
+    """
+    Decoded image of path, memory-mapped from its raw transcode, or None if
+    the transcode is missing, of another version, or stale.
+    """
+    try:
+        with open(path + '.raw', 'rb') as h:
+            header = json.loads(h.read(RAW_HEADER_SIZE))
+        stamp = _raw_stamp(path)
+    except (IOError, OSError, ValueError):
+        return None
+    if header.get('magic') != RAW_MAGIC or header.get('version') != RAW_VERSION \
+            or tuple(header['stamp']) != stamp:
+        return None
+    img = np.memmap(path + '.raw', dtype=header['dtype'], mode='r',
+                    offset=RAW_HEADER_SIZE, shape=tuple(header['shape']))
+    return np.asarray(img)
+
+
+def save_raw(path, img):
+    """
+    Writes the raw transcode of the image decoded from path next to it.
+    """
+    header = json.dumps({
+        'magic': RAW_MAGIC,
+        'version': RAW_VERSION,
+        'stamp': _raw_stamp(path),
+        'dtype': img.dtype.str,
+        'shape': img.shape,
+    })
+    fd, tmp_f = mkstemp(dir=dirname(path))
+    with fdopen(fd, 'wb') as h:
+        h.write(header.ljust(RAW_HEADER_SIZE))
+        h.write(np.ascontiguousarray(img).tobytes())
+    rename(tmp_f, path + '.raw')  # so that no one maps a partial file
+    disk_cache.add(path + '.raw')
+
+
+class DecodedImageCache(object):
+    """
+    Decoded images keyed by path, evicting the least recently used ones to
+    stay within a byte budget. Images are shared, so they are read-only.
+    With raw_store, images are decoded only once ever: later loads, also in
+    later sessions, memory-map their raw transcodes. Images without a file
+    of their own, e.g., in clip archives, come from opener, and are not
+    transcoded.
+    """
+
+    def __init__(self, max_bytes, raw_store=False):
+        self.max_bytes = max_bytes
+        self.raw_store = raw_store
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._imgs = OrderedDict()
+        self._lock = Lock()
+
+    def _get(self, key):
+        # Cached image of key, counting a hit, or None, counting a miss
+        with self._lock:
+            img = self._imgs.pop(key, None)
+            if img is None:
+                self.misses += 1
+                return None
+            self._imgs[key] = img  # most recently used
+            self.hits += 1
+            return img
+
+    def _put(self, key, img):
+        # Caches img, made read-only, under key, then evicts to stay within
+        # budget
+        img.flags.writeable = False
+        with self._lock:
+            if key not in self._imgs:
+                self._imgs[key] = img
+                self.nbytes += img.nbytes
+            while self.nbytes > self.max_bytes and self._imgs:
+                _, evicted = self._imgs.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+        return img
+
+    def load(self, path, opener=None):
+        img = self._get(path)
+        if img is not None:
+            return img
+        # Decode outside the lock so that others can hit meanwhile
+        if opener is None:
+            img = self._decode(path)
+        else:
+            img = np.array(Image.open(opener()))
+        return self._put(path, img)
+
+    def load_scaled(self, path, factor, opener=None):
+        """
+        Image of path reduced by factor, in each dimension rounded up, and
+        decoded at reduced size where the format allows, as JPEGs do.
+        """
+        key = (path, factor)
+        img = self._get(key)
+        if img is not None:
+            return img
+        im = Image.open(path if opener is None else opener())
+        w, h = im.size
+        size = (-(-w // factor), -(-h // factor))
+        im.draft(im.mode, size)
+        if im.size != size:
+            im = im.resize(size, Image.BILINEAR)
+        return self._put(key, np.array(im))
+
+    def _decode(self, path):
+        if not self.raw_store:
+            return np.array(Image.open(path))
+        img = load_raw(path)
+        if img is None:
+            img = np.array(Image.open(path))
+            save_raw(path, img)
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._imgs.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'images': len(self._imgs),
+                'bytes': self.nbytes,
+            }
+
+
+decoded_imgs = DecodedImageCache(img_cache_bytes, raw_img_store)
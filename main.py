@@ -2,19 +2,22 @@
 
 from sys import argv
 from copy import deepcopy
-from os import makedirs, remove
-from os.path import join, exists
-from shutil import rmtree
-import tarfile
+from os.path import join
 from kivy.app import App
 from kivy.properties import ObjectProperty
 from kivy.uix.screenmanager import Screen
 from app_config import app_name, clips, body_parts, part_mat, \
     button_color, label_color, lights, params_default, web_root, tmp_root, \
-    possible_mats, switchbutton_colors, readable2real, real2readable
+    possible_mats, switchbutton_colors, readable2real, real2readable, prefetch, \
+    transp_max
 from my import FloatSlider, FloatTextInput, MyDropdown, MyButton, \
-    MyCheckbox, MyLabel, MySwitchButton, MyTitleLabel, MyToggleButton
-from composite_online import main as composite, MyURLopener
+    MyCheckbox, MyLabel, MySwitchButton, MyTitleLabel, MyToggleButton, textures
+from composite_online import MyURLopener
+from predownload import predownload
+from clip_archive import clip_archives
+from prefetch import prefetcher
+from render_worker import render_worker
+from req_key import normalize, req_hash
 
 
 class ModelScreen(Screen):
@@ -80,8 +83,11 @@ class ModelScreen(Screen):
 
     def _update_params(self):
         folder = join(self.clip, 'obj')
-        if not exists(join(tmp_root, folder)):
-            makedirs(join(tmp_root, folder))
+        # From the clip archive if predownloaded into one
+        archive, name = clip_archives.find(tmp_root, join(folder, self.mode_3d + '.obj'))
+        if archive is not None:
+            self.obj_file = archive.open(name)
+            return
         # Load sculpture RGB
         remote_f = join(web_root, folder, self.mode_3d + '.obj')
         local_f = join(tmp_root, folder, self.mode_3d + '.obj')
@@ -103,8 +109,6 @@ class RenderScreen(Screen):
         # Tabs for switching screens
         self.tab.build()
 
-        self.viewer.show(self.img_file)
-
         # Body part menu
         self._add_vplaceholder()
         list_name = "Body Parts"
@@ -199,7 +203,7 @@ class RenderScreen(Screen):
             id='transp',
             screen=self,
             size_hint_x=0.2,
-            max=0.8,
+            max=transp_max,
         )
         t_transp = FloatTextInput(slider=s_transp)
         t_transp.bind(text=t_transp.on_text)
@@ -243,7 +247,6 @@ class RenderScreen(Screen):
         else:
             self.artistic_bg = button.state == 'down'
         self._update_params()
-        self.viewer.show(self.img_file)
 
     def _on_check(self, mycheckbox_ins):
         checkbox = mycheckbox_ins.ids.checkbox
@@ -296,25 +299,47 @@ class RenderScreen(Screen):
         else:
             raise ValueError(label)
         self._update_params()
-        self.viewer.show(self.img_file)
 
     def _update_params(self):
-        self.img_file = composite(
-            {
-                'clip': self.clip,
-                'density': self.stickfig_density,
-                'lights': self.lights,
-                'transp': self.sculp_transp,
-                'spec': self.sculp_spec,
-                'part': self.body_parts,
-                'mat': {
-                    k.replace(' ', ''): v
-                    for k, v in self.part_mat.iteritems()
-                },
+        # A copy, as the lists here change on the UI thread while the
+        # worker renders
+        req = normalize({
+            'clip': self.clip,
+            'density': self.stickfig_density,
+            'lights': self.lights,
+            'transp': self.sculp_transp,
+            'spec': self.sculp_spec,
+            'part': self.body_parts,
+            'mat': {
+                k.replace(' ', ''): v
+                for k, v in self.part_mat.iteritems()
             },
-            self.artistic_bg,
-            cache=True,
-        )
+        })
+        key = req_hash(req, self.artistic_bg)
+        texture = textures.get(key)
+        if texture is not None:
+            # Shown again at once, with nothing to render
+            render_worker.cancel()
+            self.viewer.busy = False
+            self.viewer.show_texture(texture)
+            self._prefetch(req)
+            return
+        # Shown when rendered in the background
+        self.viewer.busy = True
+        render_worker.submit(req, self.artistic_bg, self.viewer.view_size(),
+                             self.viewer.show, lambda comp: self._on_rendered(req, key, comp))
+
+    def _on_rendered(self, req, key, comp):
+        self.viewer.busy = False
+        if comp is not None:
+            self.viewer.show_texture(textures.put(key, comp))
+            self._prefetch(req)
+
+    def _prefetch(self, req):
+        if prefetch:
+            prefetcher.schedule(req)
+            print("Prefetched %(hits)d of %(requests)d requests (%(late)d late), "
+                  "%(files)d files, %(bytes)dB" % prefetcher.stats())
 
     def _add_hplaceholder(self):
         self.menu.add_widget(
@@ -346,29 +371,11 @@ class MyApp(App):
 
 def main():
     # Predownload data to be real-time responsive (optional)
-    folders = [
-        'obj',
-        'frames_for-ui-resp',
-        'composite_enum_idxmap_for-ui-resp',
-        'render_enum_for-ui-resp',
-    ]
     if len(argv) > 1:
         # One or more clips given for pre-downloading
-        for clip_name in argv[1:]:
-            clip_name = readable2real[clip_name]
-            for folder in folders:
-                remote_folder = join(web_root, clip_name, folder)
-                local_folder = join(tmp_root, clip_name, folder)
-                local_zip = local_folder + '.tar.gz'
-                MyURLopener().lazy_retrieve(remote_folder + '.tar.gz', local_zip)
-                h = tarfile.open(local_zip, "r:gz")
-                if exists(local_folder):
-                    rmtree(local_folder)
-                makedirs(local_folder)
-                h.extractall(join(local_folder, '..'))
-                h.close()
+        predownload(argv[1:])
         # Update default clip to the final pre-downloaded clip
-        params_default['clip'] = clip_name
+        params_default['clip'] = readable2real[argv[-1]]
 
     MyApp().run()
 
@@ -1,14 +1,17 @@
 # pylint: disable=W0108,R0903,W0201,W0212,E1003,E0632,E0203
 
-from app_config import togglebutton_colors
+from collections import OrderedDict
+from time import time
+from app_config import togglebutton_colors, slider_interval, texture_cache_bytes
 from kivy.clock import Clock
 from kivy.core.window import Window
 from kivy.graphics import Callback, Color, Mesh, PopMatrix, PushMatrix, \
     RenderContext, Rotate, Scale, Translate, UpdateNormalMatrix
 from kivy.graphics.opengl import GL_DEPTH_TEST, glDisable, glEnable
+from kivy.graphics.texture import Texture
 from kivy.graphics.transformation import Matrix
 from kivy.logger import Logger
-from kivy.properties import ListProperty, NumericProperty, ObjectProperty, \
+from kivy.properties import BooleanProperty, ListProperty, NumericProperty, ObjectProperty, \
     StringProperty
 from kivy.resources import resource_find
 from kivy.uix.boxlayout import BoxLayout
@@ -65,12 +68,9 @@ class ScreenTab(BoxLayout):
                 b.state = 'normal'
         # Refresh viewers to avoid switching clips
         s.clip = clip
+        s._update_params()
         if screen_id == 'model_screen':
-            s._update_params()
             s.viewer.show(s.obj_file)
-        else:
-            s._update_params()
-            s.viewer.show(s.img_file)
 
 
 class Interactive(BoxLayout):
@@ -81,29 +81,57 @@ class Interactive(BoxLayout):
 
 
 class Renderer(Widget):
+    """
+    Draws the scene only when it changes: Kivy redraws the canvas when the
+    meshes are rotated or scaled, and uniforms are updated only when the
+    widget is resized or given a new scene, at most once a frame.
+    """
 
     def __init__(self, **kwargs):
         super(Renderer, self).__init__(**kwargs)
         self.canvas = RenderContext(compute_normal_mat=True)
         self.canvas.shader.source = resource_find('simple.glsl')
         self._touches = []
+        # Counters, to check that nothing is drawn or updated while idle
+        self.frames = 0
+        self.frame_seconds = 0.
+        self.uniform_updates = 0
+        self._frame_start = None
+        self._trigger_update_glsl = Clock.create_trigger(self._update_glsl)
+        self.bind(size=self._trigger_update_glsl)
 
     def render(self, obj_file):
         self.canvas.clear()
         self.scene = ObjFile(obj_file)
         with self.canvas:
-            self.cb = Callback(
-                lambda args: glEnable(GL_DEPTH_TEST)
-            )
+            self.cb = Callback(self._begin_frame)
             PushMatrix()
             self._setup_scene()
             PopMatrix()
-            self.cb = Callback(
-                lambda args: glDisable(GL_DEPTH_TEST)
-            )
-        Clock.schedule_interval(self._update_glsl, 1 / 60.)
+            self.cb = Callback(self._end_frame)
+        self._trigger_update_glsl()
+
+    def _begin_frame(self, *_):
+        self._frame_start = time()
+        glEnable(GL_DEPTH_TEST)
+
+    def _end_frame(self, *_):
+        glDisable(GL_DEPTH_TEST)
+        if self._frame_start is not None:
+            self.frames += 1
+            self.frame_seconds += time() - self._frame_start
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'frame_ms': 1e3 * self.frame_seconds / max(self.frames, 1),
+            'uniform_updates': self.uniform_updates,
+        }
 
     def _update_glsl(self, *_):
+        if self.parent is None or self.parent.parent is None:
+            return  # not laid out yet; updated once resized
+        self.uniform_updates += 1
         p = self.parent.parent
         asp = float(p.width) / p.height * p.size_hint_y / p.size_hint_x
         proj = Matrix().view_clip(-asp, asp, -1, 1, 1, 100, 1)
@@ -150,7 +178,6 @@ class Renderer(Widget):
     def on_touch_move(self, touch):
         if touch.grab_current is self:
             scale_factor = 0.01
-            self._update_glsl()
             if touch in self._touches:
                 if len(self._touches) == 1:
                     ax, ay = self._angle_from_touch(touch)
@@ -187,6 +214,8 @@ class Renderer(Widget):
         if touch.grab_current is self:
             touch.ungrab(self)
             self._touches.remove(touch)
+            Logger.debug("Renderer: %(frames)d frames drawn, %(frame_ms).2fms each, "
+                         "%(uniform_updates)d uniform updates" % self.stats())
 
 
 class HorizontalMenu(BoxLayout):
@@ -199,10 +228,66 @@ class VerticalMenu(BoxLayout):
 
 class Picture(BoxLayout):
     img = ObjectProperty(None)
+    busy = BooleanProperty(False)  # while a new image is being rendered
+
+    _laid_out = False
+
+    def on_size(self, *_):
+        self._laid_out = True
+
+    def view_size(self):
+        """
+        Size that images are shown within, or None until laid out.
+        """
+        return tuple(self.size) if self._laid_out else None
 
     def show(self, img_file):
         self.img.source = img_file  # local or online
 
+    def show_texture(self, texture):
+        self.img.source = ''  # so that the texture is not reloaded from it
+        self.img.texture = texture
+
+
+class TextureCache(object):
+    """
+    Textures of recent composites, for showing them again with no decoding
+    or upload, least recently used evicted beyond max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._textures = OrderedDict()  # key -> (texture, bytes), oldest first
+
+    def get(self, key):
+        entry = self._textures.pop(key, None)
+        if entry is None:
+            return None
+        self._textures[key] = entry  # most recently used
+        return entry[0]
+
+    def put(self, key, comp):
+        """
+        Texture of 8-bit RGB composite comp, blitted directly from its buffer.
+        """
+        h, w = comp.shape[:2]
+        texture = Texture.create(size=(w, h), colorfmt='rgb')
+        texture.blit_buffer(comp.tostring(), colorfmt='rgb', bufferfmt='ubyte')
+        texture.flip_vertical()  # rows of arrays go top down
+        old = self._textures.pop(key, None)
+        if old is not None:
+            self.nbytes -= old[1]
+        self._textures[key] = (texture, comp.nbytes)
+        self.nbytes += comp.nbytes
+        while self.nbytes > self.max_bytes and len(self._textures) > 1:
+            _, (_, n_bytes) = self._textures.popitem(last=False)
+            self.nbytes -= n_bytes
+        return texture
+
+
+textures = TextureCache(texture_cache_bytes)
+
 
 class MyButton(Button):
     pass
@@ -303,21 +388,41 @@ class MyCheckbox(BoxLayout):
 class FloatSlider(Slider):
     screen = ObjectProperty(None)
     textinput = ObjectProperty(None)
+    # Changes within this many seconds, or within a frame if 0, make one render
+    interval = NumericProperty(slider_interval)
+    params = {'density': 'stickfig_density', 'transp': 'sculp_transp'}
+
+    def __init__(self, **kwargs):
+        super(FloatSlider, self).__init__(**kwargs)
+        self._trigger_update = Clock.create_trigger(self._update, self.interval)
+
+    def quantize(self, value):
+        """
+        Closest value in range on a step, as the server has for sliders
+        """
+        v = float(value)
+        if self.step:
+            v = self.min + round((v - self.min) / self.step) * self.step
+        return round(min(max(v, self.min), self.max), 2)
 
     def on_slide(self, instance, value):
         """
-        Update text input box
+        Update text input box, and the screen once changes settle
         """
-        self.textinput.text = str(value)
+        text = str(self.quantize(value))
+        if self.textinput.text != text:
+            self.textinput.text = text
+        self._trigger_update()
+
+    def _update(self, *_):
         s = self.screen
-        if instance.id == 'density':
-            s.stickfig_density = value
-        elif instance.id == 'transp':
-            s.sculp_transp = value
-        else:
-            raise ValueError(instance.id)
+        if self.id not in self.params:
+            raise ValueError(self.id)
+        value = self.quantize(self.value)
+        if getattr(s, self.params[self.id]) == value:
+            return  # e.g., dragged back, or echoed by the text input
+        setattr(s, self.params[self.id], value)
         s._update_params()
-        s.viewer.show(s.img_file)
 
 
 class FrameSlider(Slider):
@@ -353,10 +458,13 @@ class FloatTextInput(MyTextInput):
             Logger.warn("Failed to convert '%s' to float" % value)
             v = None
         if v is not None:
-            v = min(max(v, 0), 1)
-            self.slider.value = v
+            v = self.slider.quantize(v)
+            # Only what changes, so that the slider does not echo back
+            if self.slider.value != v:
+                self.slider.value = v
             self.value = v
-            self.text = str(v)
+            if self.text != str(v):
+                self.text = str(v)
 
 
 class FrameTextInput(MyTextInput):
@@ -62,7 +62,13 @@ class ObjFile:
         self._current_object = None
 
         material = None
-        for line in open(filename, "r"):
+        if hasattr(filename, 'read'):
+            # File-like, e.g., from a clip archive
+            filename.seek(0)
+            lines = filename
+        else:
+            lines = open(filename, "r")
+        for line in lines:
             if line.startswith('#'):
                 continue
             if line.startswith('s'):
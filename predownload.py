@@ -0,0 +1,186 @@
+"""
+Downloads all ingredient data of clips ahead of time, e.g.,
+
+    python predownload.py Ballet-1 Cartwheel -j 4
+
+By default, each clip goes into a single clip archive; with --extract, its
+folders are extracted into files instead.
+"""
+
+from argparse import ArgumentParser
+from os import makedirs, rename, walk
+from os.path import join, exists, normpath
+from shutil import rmtree
+from tempfile import mkdtemp
+from socket import error as SocketError
+from httplib import HTTPException
+from multiprocessing.pool import ThreadPool
+from time import time
+import tarfile
+from app_config import web_root, tmp_root, readable2real, predownload_workers, \
+    predownload_archive, fetch_retries
+from fetch import get_fetcher
+from clip_archive import ArchiveWriter, archive_path, folders
+from disk_cache import disk_cache
+
+
+# Marks a folder as completely extracted
+done_marker = '.predownloaded'
+
+
+class CountingReader(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.n_bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size) if size >= 0 else self.fileobj.read()
+        self.n_bytes += len(data)
+        return data
+
+
+def stream_extract(clip_name, folder, web_root=web_root, tmp_root=tmp_root,
+                   force=False):
+    """
+    Extracts clip_name/folder.tar.gz into tmp_root while it downloads,
+    without keeping the archive. The extracted folder replaces any existing
+    one only once complete. Returns the number of bytes downloaded.
+    """
+    local_folder = join(tmp_root, clip_name, folder)
+    if not force and exists(join(local_folder, done_marker)):
+        print("%s already predownloaded -- skipped" % local_folder)
+        return 0
+    clip_dir = join(tmp_root, clip_name)
+    if not exists(clip_dir):
+        try:
+            makedirs(clip_dir)
+        except OSError:  # made by another thread meanwhile
+            pass
+    fetcher = get_fetcher(web_root)
+    for attempt in range(fetch_retries + 1):
+        staging_dir = mkdtemp(dir=clip_dir)
+        try:
+            try:
+                resp = CountingReader(fetcher.open(join(clip_name, folder + '.tar.gz')))
+                h = tarfile.open(fileobj=resp, mode='r|gz')
+                for member in h:
+                    # Only what belongs in the folder
+                    name = normpath(member.name)
+                    if name == folder or name.startswith(folder + '/'):
+                        h.extract(member, staging_dir)
+                h.close()
+                resp.read()  # rest of the stream, so that the connection can be reused
+            except (HTTPException, SocketError, IOError, tarfile.TarError):
+                fetcher.drop_conn()
+                if attempt == fetch_retries:
+                    raise
+                continue
+            open(join(staging_dir, folder, done_marker), 'w').close()
+            if exists(local_folder):
+                rmtree(local_folder)
+            rename(join(staging_dir, folder), local_folder)
+            break
+        finally:
+            # Whatever is left of it, also on errors not retried, e.g.,
+            # FileNotOnServerException
+            rmtree(staging_dir, ignore_errors=True)
+    for d, _, fs in walk(local_folder):
+        for f in fs:
+            disk_cache.add(join(d, f))
+    return resp.n_bytes
+
+
+def stream_archive(clip_name, folders=folders, web_root=web_root,
+                   tmp_root=tmp_root, force=False):
+    """
+    Writes the folders of a clip into its archive while they download,
+    one after another. Returns the number of bytes downloaded.
+    """
+    out_f = archive_path(tmp_root, clip_name)
+    if not force and exists(out_f):
+        print("%s already predownloaded -- skipped" % out_f)
+        return 0
+    if not exists(tmp_root):
+        try:
+            makedirs(tmp_root)
+        except OSError:  # made by another thread meanwhile
+            pass
+    fetcher = get_fetcher(web_root)
+    writer = ArchiveWriter(out_f)
+    n_bytes = 0
+    try:
+        for folder in folders:
+            mark = writer.mark()
+            for attempt in range(fetch_retries + 1):
+                try:
+                    resp = CountingReader(fetcher.open(join(clip_name, folder + '.tar.gz')))
+                    h = tarfile.open(fileobj=resp, mode='r|gz')
+                    writer.add_tar(h)
+                    h.close()
+                    resp.read()  # rest of the stream, so that the connection can be reused
+                    break
+                except (HTTPException, SocketError, IOError, tarfile.TarError):
+                    fetcher.drop_conn()
+                    writer.rollback(mark)
+                    if attempt == fetch_retries:
+                        raise
+            n_bytes += resp.n_bytes
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    return n_bytes
+
+
+def predownload(clip_names, folders=folders, workers=predownload_workers,
+                force=False, archive=predownload_archive):
+    """
+    Predownloads clips, given by their readable names, with up to workers
+    jobs at a time. Jobs are clips when writing archives, and folders
+    otherwise.
+    """
+    if archive:
+        jobs = [(readable2real[c],) for c in clip_names]
+    else:
+        jobs = [(readable2real[c], f) for c in clip_names for f in folders]
+
+    def run(job):
+        t0 = time()
+        if archive:
+            n_bytes = stream_archive(job[0], folders, force=force)
+        else:
+            n_bytes = stream_extract(*job, force=force)
+        if n_bytes > 0:
+            duration = time() - t0
+            print("Predownloaded %s: %dMB in %ds (%dKB/s)" % (
+                '/'.join(job), n_bytes / (1024 * 1024), duration,
+                n_bytes / (1024 * max(duration, 1e-6))))
+        return n_bytes
+
+    t0 = time()
+    pool = ThreadPool(workers)
+    n_bytes = sum(pool.map(run, jobs))
+    pool.close()
+    disk_cache.evict()
+    duration = time() - t0
+    print("Predownloaded %d %s: %dMB in %ds (%dKB/s)" % (
+        len(jobs), 'clips' if archive else 'folders', n_bytes / (1024 * 1024),
+        duration, n_bytes / (1024 * max(duration, 1e-6))))
+
+
+def main():
+    parser = ArgumentParser(description="Predownload ingredient data of clips")
+    parser.add_argument('clips', nargs='+', choices=sorted(readable2real))
+    parser.add_argument('-j', '--workers', type=int, default=predownload_workers,
+                        help="clips, or folders with --extract, to download at a time")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="download again what is already predownloaded")
+    parser.add_argument('--extract', action='store_true',
+                        help="extract folders into files instead of writing clip archives")
+    args = parser.parse_args()
+    predownload(args.clips, workers=args.workers, force=args.force,
+                archive=predownload_archive and not args.extract)
+
+
+if __name__ == '__main__':
+    main()
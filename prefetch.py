@@ -0,0 +1,229 @@
+from copy import deepcopy
+from collections import OrderedDict
+from os import statvfs
+from os.path import join
+from threading import Condition, Thread
+from time import time
+from app_config import web_root, tmp_root, body_parts, lights, prefetch_candidates, \
+    prefetch_bytes, prefetch_rate, prefetch_min_free
+from fetch import get_fetcher
+from clip_archive import clip_archives
+from idxmap_cache import idxmaps
+from composite_online import idxmap_file, list_ingredients
+from disk_cache import disk_cache
+from req_key import normalize
+
+
+# As the density slider in my.kv
+density_step = 0.2
+density_max = 1
+
+# Kinds of changes between consecutive requests
+kinds = ['density', 'spec', 'lights', 'part']
+
+
+def ingredients_key(req):
+    # Requests with the same key need the same ingredients
+    return (
+        req['clip'],
+        '%.2f' % req['density'],
+        bool(req['spec']),
+        tuple(sorted(req['lights'])),
+        tuple(sorted((p, req['mat'][p]) for p in req['part'])),
+    )
+
+
+def change_kind(req0, req1):
+    """
+    Kind of change from req0 to req1, or None if not a single one.
+    """
+    key0, key1 = ingredients_key(req0), ingredients_key(req1)
+    if key0[0] != key1[0]:
+        return None
+    changed = [k for k, x0, x1 in zip(kinds, key0[1:], key1[1:]) if x0 != x1]
+    return changed[0] if len(changed) == 1 else None
+
+
+def neighbours(req):
+    """
+    Requests one click away from normalized req, by kind of change.
+    """
+    cands = {k: [] for k in kinds}
+
+    def changed(**kwargs):
+        cand = deepcopy(req)
+        cand.update(kwargs)
+        return normalize(cand)
+
+    for d in (req['density'] - density_step, req['density'] + density_step):
+        if -1e-6 < d < density_max + 1e-6:
+            cands['density'].append(changed(density=round(d, 2)))
+    cands['spec'].append(changed(spec=not req['spec']))
+    for l in lights:
+        if l not in req['lights']:
+            cands['lights'].append(changed(lights=req['lights'] + [l]))
+        elif len(req['lights']) > 1:
+            cands['lights'].append(changed(lights=[x for x in req['lights'] if x != l]))
+    for p in body_parts:
+        p = p.replace(' ', '')
+        if p not in req['part']:
+            cands['part'].append(changed(part=req['part'] + [p]))
+        elif len(req['part']) > 1:
+            cands['part'].append(changed(part=[x for x in req['part'] if x != p]))
+    return cands
+
+
+class Prefetcher(object):
+    """
+    Downloads, in the background, ingredients of the requests most likely
+    to come after the latest one, within a byte budget per request and a
+    bandwidth limit. Likelihoods follow how often each kind of change has
+    been seen. A new request cancels prefetching for the previous one.
+    """
+
+    def __init__(self, web_root, tmp_root, n_candidates=prefetch_candidates,
+                 max_bytes=prefetch_bytes, rate=prefetch_rate,
+                 min_free=prefetch_min_free):
+        self.web_root = web_root
+        self.tmp_root = tmp_root
+        self.n_candidates = n_candidates
+        self.max_bytes = max_bytes
+        self.rate = rate
+        self.min_free = min_free
+        self.generation = 0
+        self.counts = {k: 0 for k in kinds}
+        self.requests = 0
+        self.hits = 0  # requests prefetched completely before they came
+        self.late = 0  # requests being prefetched when they came
+        self.files = 0
+        self.bytes = 0
+        self._cond = Condition()
+        self._pending = None
+        self._last = None
+        self._candidates = set()
+        self._ready = OrderedDict()
+        self._thread = None
+
+    def rank(self, req):
+        """
+        Neighbours of req, most likely first.
+        """
+        n_seen = sum(self.counts.itervalues())
+        scored = []
+        for k, cands in neighbours(req).iteritems():
+            p = float(self.counts[k] + 1) / (n_seen + len(kinds))
+            scored += [(p / len(cands), cand) for cand in cands]
+        scored.sort(key=lambda x: -x[0])
+        return [cand for _, cand in scored]
+
+    def schedule(self, req):
+        """
+        Records req, and starts prefetching its likely successors in place
+        of those of the previous request.
+        """
+        req = normalize(req)
+        key = ingredients_key(req)
+        with self._cond:
+            self.requests += 1
+            if key in self._ready:
+                self.hits += 1
+            elif key in self._candidates:
+                self.late += 1
+            if self._last is not None:
+                kind = change_kind(self._last, req)
+                if kind is not None:
+                    self.counts[kind] += 1
+            self._last = req
+            self.generation += 1
+            self._pending = (self.generation, req)
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'requests': self.requests,
+                'hits': self.hits,
+                'late': self.late,
+                'hit_rate': float(self.hits) / max(self.requests, 1),
+                'files': self.files,
+                'bytes': self.bytes,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                generation, req = self._pending
+                self._pending = None
+            try:
+                self._prefetch_all(req, generation)
+            except Exception as e:  # pylint: disable=W0703
+                print("Prefetching failed: %s" % e)
+
+    def _prefetch_all(self, req, generation):
+        # Prefetches the likely successors of req, most likely first
+        self._budget = self.max_bytes
+        self._t0, self._n_bytes = time(), 0
+        cands = [c for c in self.rank(req) if ingredients_key(c) not in self._ready]
+        cands = cands[:self.n_candidates]
+        with self._cond:
+            self._candidates = set(ingredients_key(c) for c in cands)
+        for cand in cands:
+            try:
+                done = self._prefetch(cand, generation)
+            except Exception as e:  # pylint: disable=W0703
+                print("Prefetching failed: %s" % e)
+                continue
+            if not done:
+                break
+            with self._cond:
+                self._ready[ingredients_key(cand)] = True
+                while len(self._ready) > 256:
+                    self._ready.popitem(last=False)
+        disk_cache.evict()
+
+    def _stale(self, generation):
+        return generation != self.generation
+
+    def _prefetch(self, req, generation):
+        # Downloads what req needs; False if cancelled or out of budget
+        fetcher = get_fetcher(self.web_root)
+        f = idxmap_file(req)
+        archive, name = clip_archives.find(self.tmp_root, f)
+        if archive is not None:
+            precomp = idxmaps.load(name, archive)
+        else:
+            if not self._fetch(fetcher, f, generation):
+                return False
+            precomp = idxmaps.load(join(self.tmp_root, f))
+        for _, f in list_ingredients(req, precomp):
+            if clip_archives.find(self.tmp_root, f)[0] is None:
+                if not self._fetch(fetcher, f, generation):
+                    return False
+        return True
+
+    def _fetch(self, fetcher, f, generation):
+        if self._stale(generation) or self._budget <= 0:
+            return False
+        st = statvfs(self.tmp_root)
+        if st.f_bavail * st.f_frsize < self.min_free:
+            return False
+        n_bytes = fetcher.fetch(f, join(self.tmp_root, f))
+        self._budget -= n_bytes
+        self._n_bytes += n_bytes
+        with self._cond:
+            self.files += n_bytes > 0
+            self.bytes += n_bytes
+            # Keep to the bandwidth limit, waking up early when cancelled
+            delay = float(self._n_bytes) / self.rate - (time() - self._t0)
+            if delay > 0 and not self._stale(generation):
+                self._cond.wait(delay)
+        return not self._stale(generation)
+
+
+prefetcher = Prefetcher(web_root, tmp_root)
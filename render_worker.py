@@ -0,0 +1,89 @@
+"""
+Renders requests off the UI thread, so that downloading and compositing do
+not freeze the window.
+"""
+
+from threading import Condition, Thread
+from kivy.clock import Clock
+from app_config import progressive
+from composite_online import main as composite, preview, is_cached, RenderCancelled
+
+
+class RenderWorker(object):
+    """
+    Renders one request at a time on a background thread, newest first: a
+    request submitted while another waits replaces it, and one that is
+    superseded while running is cancelled before compositing if it has not
+    started yet, and not delivered otherwise. Composites are delivered, as
+    arrays, on the UI thread through Clock, preceded by a preview if
+    progressive.
+    """
+
+    def __init__(self, progressive=progressive):
+        self.progressive = progressive
+        self.generation = 0
+        self._cond = Condition()
+        self._pending = None
+        self._thread = None
+
+    def submit(self, req, artistic_bg, size, on_preview, on_done):
+        """
+        Renders req in place of any earlier request, calling
+        on_preview(img_file) with the preview for size, None for the default,
+        if one is made, and then on_done(comp) with the composite, or None if
+        rendering failed.
+        """
+        with self._cond:
+            self.generation += 1
+            self._pending = (self.generation, req, artistic_bg, size, on_preview, on_done)
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def cancel(self):
+        """
+        Drops the requests submitted so far, e.g., when the image is at
+        hand already.
+        """
+        with self._cond:
+            self.generation += 1
+            self._pending = None
+
+    def _stale(self, generation):
+        return generation != self.generation
+
+    def _deliver(self, generation, callback, arg):
+        # On the UI thread, unless superseded by then
+        def deliver(_):
+            if not self._stale(generation):
+                callback(arg)
+        Clock.schedule_once(deliver, 0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                generation, req, artistic_bg, size, on_preview, on_done = self._pending
+                self._pending = None
+            comp = None
+            try:
+                if self.progressive and not is_cached(req, artistic_bg):
+                    preview_f = preview(req, artistic_bg, size=size)
+                    if preview_f is not None:
+                        self._deliver(generation, on_preview, preview_f)
+                if self._stale(generation):
+                    continue
+                comp = composite(req, artistic_bg, cache=True, array=True,
+                                 cancelled=lambda: self._stale(generation))
+            except RenderCancelled:
+                print("Render superseded -- cancelled")
+                continue
+            except Exception as e:  # pylint: disable=W0703
+                print("Rendering failed: %s" % e)
+            self._deliver(generation, on_done, comp)
+
+
+render_worker = RenderWorker()
@@ -0,0 +1,158 @@
+"""
+Canonical form of compositing requests, and the composite cache keyed by it.
+"""
+
+import json
+from hashlib import sha1
+from os import listdir, remove, rename, walk
+from os.path import join, isdir
+from shutil import rmtree
+from app_config import readable2real, body_parts, lights, possible_mats
+from disk_cache import disk_cache
+
+
+# Material names as on the server
+server_mats = {'Original': 'Orig'}
+
+clip_names = set(readable2real.values())
+part_names = set(p.replace(' ', '') for p in body_parts)
+mat_names = set(server_mats.get(m, m) for m in possible_mats)
+
+
+def _quantize(x, lo, hi, name):
+    x = round(float(x), 2)
+    if not lo <= x <= hi:
+        raise ValueError("%s %s not in [%s, %s]" % (name, x, lo, hi))
+    return x
+
+
+def normalize(req):
+    """
+    Validated, canonical copy of a request, leaving req untouched: part
+    names without spaces, parts and lights sorted and unique, materials
+    named as on the server, and floats quantized to the precision of the
+    server's files.
+    """
+    if req['clip'] not in clip_names:
+        raise ValueError("Unknown clip %s" % req['clip'])
+    parts = sorted(set(p.replace(' ', '') for p in req['part']))
+    if not parts or not part_names.issuperset(parts):
+        raise ValueError("Invalid body parts %s" % req['part'])
+    req_lights = sorted(set(req['lights']))
+    if not req_lights or not set(lights).issuperset(req_lights):
+        raise ValueError("Invalid lights %s" % req['lights'])
+    mat = {}
+    for p, m in req['mat'].iteritems():
+        m = server_mats.get(m, m)
+        if m not in mat_names:
+            raise ValueError("Unknown material %s" % m)
+        mat[p.replace(' ', '')] = m
+    missing = [p for p in parts if p not in mat]
+    if missing:
+        raise ValueError("No material for %s" % missing)
+    return {
+        'clip': req['clip'],
+        'density': _quantize(req['density'], 0, 1, 'density'),
+        'lights': req_lights,
+        'transp': _quantize(req['transp'], 0, 1, 'transp'),
+        'spec': bool(req['spec']),
+        'part': parts,
+        'mat': mat,  # of all parts given, so that others can be added
+    }
+
+
+def key_of(req, artistic_bg):
+    """
+    Everything that determines the composite of a normalized request.
+    """
+    return {
+        'clip': req['clip'],
+        'density': '%.2f' % req['density'],
+        'lights': req['lights'],
+        'transp': '%.2f' % req['transp'],
+        'spec': req['spec'],
+        'part': req['part'],
+        'mat': [req['mat'][p] for p in req['part']],
+        'artistic_bg': bool(artistic_bg),
+    }
+
+
+def req_hash(req, artistic_bg):
+    """
+    Short, stable hash of the composite of a normalized request.
+    """
+    key = json.dumps(key_of(req, artistic_bg), sort_keys=True)
+    return sha1(key).hexdigest()[:16]
+
+
+def comp_file(tmp_root, req, artistic_bg, ext='.png'):
+    return join(tmp_root, 'composites', req_hash(req, artistic_bg) + ext)
+
+
+def parse_legacy(req_dir):
+    """
+    Request of a legacy composite_enum directory, whose path was the request
+    string with '_' replaced by '/'. Returns None if it does not parse.
+    """
+    fields = {}
+    last = None
+    for seg in req_dir.split('/'):
+        k, _, v = seg.partition('.')
+        if k in ('clip', 'density', 'lights', 'transp', 'spec', 'part', 'mat') and v:
+            fields[k] = v
+            last = k
+        elif last is not None:
+            # '_' that was part of a value, as in clip names
+            fields[last] += '_' + seg
+        else:
+            return None
+    try:
+        parts = fields['part'].split('-')
+        mats = fields['mat'].split('-')
+        if len(mats) != len(parts):
+            return None
+        return normalize({
+            'clip': fields['clip'],
+            'density': float(fields['density']),
+            'lights': fields['lights'].split('-'),
+            'transp': float(fields['transp']),
+            'spec': float(fields['spec']) > 0,
+            'part': parts,
+            'mat': dict(zip(sorted(parts), mats)),
+        })
+    except (KeyError, ValueError):
+        return None
+
+
+def migrate(tmp_root):
+    """
+    Moves composites from the legacy composite_enum layout into the flat
+    cache, dropping duplicates and those that do not parse.
+    """
+    n_moved, n_dropped = 0, 0
+    clips = [c for c in listdir(tmp_root) if isdir(join(tmp_root, c, 'composite_enum'))] \
+        if isdir(tmp_root) else []
+    for clip in clips:
+        legacy_root = join(tmp_root, clip, 'composite_enum')
+        for d, _, fs in walk(legacy_root):
+            for f in fs:
+                path = join(d, f)
+                req_dir = d[(len(legacy_root) + 1):]
+                req = parse_legacy(req_dir) if f in ('comp.png', 'comp_2x.png') else None
+                disk_cache.forget(path)
+                if req is None:
+                    remove(path)
+                    n_dropped += 1
+                    continue
+                dst = comp_file(tmp_root, req, f == 'comp_2x.png')
+                if disk_cache.contains(dst):
+                    remove(path)
+                    n_dropped += 1
+                    continue
+                disk_cache.ensure_dirs([join(tmp_root, 'composites')])
+                rename(path, dst)
+                disk_cache.add(dst)
+                n_moved += 1
+        rmtree(legacy_root)
+    if clips:
+        print("Migrated %d cached composites, dropped %d" % (n_moved, n_dropped))
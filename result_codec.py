@@ -0,0 +1,150 @@
+"""
+Formats of the composite cache: how composites are encoded into files, and
+decoded from them. Codecs can be compared on cached composites with, e.g.,
+
+    python result_codec.py /tmp/mosculp_gui/composites/0123456789abcdef.png
+"""
+
+from argparse import ArgumentParser
+from glob import glob
+from os import close, remove
+from os.path import join, getsize, splitext
+from tempfile import mkstemp
+from time import time
+import numpy as np
+from PIL import Image, features
+from app_config import tmp_root
+
+
+class PNGCodec(object):
+    """
+    PNG, lossless; lower compress levels encode faster into larger files.
+    """
+    ext = '.png'
+
+    def __init__(self, compress_level=6):
+        self.compress_level = compress_level
+
+    def encode(self, comp, fileobj):
+        Image.fromarray(comp).save(fileobj, format='PNG', compress_level=self.compress_level)
+
+    def decode(self, path):
+        return np.array(Image.open(path))
+
+
+class NPYCodec(object):
+    """
+    Raw .npy arrays, decoded lazily: they are memory-mapped, and their
+    pages read only when used.
+    """
+    ext = '.npy'
+
+    def encode(self, comp, fileobj):
+        np.save(fileobj, comp)
+
+    def decode(self, path):
+        return np.load(path, mmap_mode='r')
+
+
+class WebPCodec(object):
+    """
+    Lossless WebP, if Pillow was built with it; method trades encoding
+    time, from 0, for size, up to 6.
+    """
+    ext = '.webp'
+
+    def __init__(self, method=0):
+        self.method = method
+
+    def encode(self, comp, fileobj):
+        Image.fromarray(comp).save(fileobj, format='WEBP', lossless=True, quality=0,
+                                   method=self.method)
+
+    def decode(self, path):
+        return np.array(Image.open(path).convert('RGB'))
+
+
+codecs = {
+    'png': PNGCodec(6),
+    'png_fast': PNGCodec(1),
+    'npy': NPYCodec(),
+}
+if features.check('webp'):
+    codecs['webp'] = WebPCodec()
+
+
+def get_codec(name):
+    if name not in codecs:
+        print("Codec %s not available -- using png" % name)
+        return codecs['png']
+    return codecs[name]
+
+
+def codec_of(path):
+    """
+    Codec that decodes path, by its extension.
+    """
+    ext = splitext(path)[1]
+    for codec in codecs.itervalues():
+        if codec.ext == ext:
+            return codec
+    raise ValueError("No codec for %s" % path)
+
+
+def benchmark(comp_fs, repeats=3):
+    """
+    Encoding and decoding times, and file sizes, of each codec on the
+    composites in comp_fs, averaged over them.
+    """
+    comps = [codec_of(f).decode(f) for f in comp_fs]
+    comps = [np.ascontiguousarray(comp[:, :, :3]) for comp in comps]
+    results = {}
+    for name, codec in sorted(codecs.iteritems()):
+        t_encode, t_decode, t_first, n_bytes = 0., 0., 0., 0
+        for comp in comps:
+            fd, tmp_f = mkstemp(suffix=codec.ext)
+            close(fd)
+            try:
+                for _ in range(repeats):
+                    t0 = time()
+                    with open(tmp_f, 'wb') as h:
+                        codec.encode(comp, h)
+                    t_encode += (time() - t0) / repeats
+                n_bytes += getsize(tmp_f)
+                for _ in range(repeats):
+                    t0 = time()
+                    decoded = codec.decode(tmp_f)
+                    t1 = time()
+                    decoded = np.array(decoded)  # all pixels read
+                    t_first += (t1 - t0) / repeats
+                    t_decode += (time() - t0) / repeats
+                if not np.array_equal(decoded, comp):
+                    raise ValueError("%s is not lossless" % name)
+            finally:
+                remove(tmp_f)
+        n = float(len(comps))
+        results[name] = {
+            'encode': t_encode / n,
+            'decode': t_decode / n,
+            'first': t_first / n,
+            'bytes': n_bytes / n,
+        }
+        print("%-8s encode %7.1fms, decode %7.1fms (%6.1fms until returned), %9dB" % (
+            name, 1e3 * t_encode / n, 1e3 * t_decode / n, 1e3 * t_first / n, n_bytes / n))
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Compare codecs of the composite cache")
+    parser.add_argument('comps', nargs='*',
+                        help="composites to encode; some of the cache by default")
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_args()
+    comp_fs = args.comps or sorted(glob(join(tmp_root, 'composites', '*.png')))[:5]
+    if not comp_fs:
+        parser.error("no composites given or cached")
+    benchmark(comp_fs, args.repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Matting engines and precisions against simple_matting() in float64, on
+synthetic clips, e.g.,
+
+    python -m unittest discover tests
+"""
+
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+import numpy as np
+import composite_online
+from composite_online import combine_shadow, composite, matting_engines, precisions, \
+    estimate_peak_bytes, _kernel_radius, _plan
+from disk_cache import DiskCache
+
+
+def synthetic(h=120, w=200, n_frames=5, parts=('Body', 'LeftUpperArm'), seed=0):
+    # Frames, sculptures and their backgrounds as random images, with blobs
+    # of frames and boxes of sculptures in the index maps; the last frame
+    # is the background
+    rng = np.random.RandomState(seed)
+    frames = ['%05d' % (10 * i) for i in range(n_frames)]
+    idx_names = frames + ['sculp_' + p for p in parts]
+    curr = np.full((h, w), n_frames - 1, dtype=np.int64)
+    prev = curr.copy()
+    yy, xx = np.mgrid[:h, :w]
+    for i in range(n_frames - 1):
+        cy, cx = rng.randint(20, h - 20), rng.randint(20, w - 20)
+        blob = (yy - cy) ** 2 + (xx - cx) ** 2 < rng.randint(100, 600)
+        curr[blob] = i
+        prev[blob] = i
+    for j in range(len(parts)):
+        cy, cx = rng.randint(20, h - 20), rng.randint(20, w - 20)
+        box = (abs(yy - cy) < 15) & (abs(xx - cx) < 40)
+        prev[box] = curr[box]
+        curr[box] = n_frames + j
+    imgs = {x: rng.randint(0, 256, (h, w, 3)).astype(np.uint8) for x in idx_names}
+    for p in parts:
+        imgs['bg_' + p] = rng.randint(0, 256, (h, w, 3)).astype(np.uint8)
+    precomp = {
+        'idx_names': idx_names,
+        'curr_idx_map': curr,
+        'prev_idx_map': prev,
+        'is_fg': curr != n_frames - 1,
+    }
+    return imgs, precomp
+
+
+def centered(x, shape, fill):
+    # x in the middle of an array of shape, as composite() places frames on
+    # backgrounds larger than them
+    h, w = x.shape[:2]
+    top, left = (shape[0] - h) // 2, (shape[1] - w) // 2
+    out = np.full(shape + x.shape[2:], fill, dtype=x.dtype)
+    out[top:(top + h), left:(left + w)] = x
+    return out
+
+
+def render(imgs, precomp, sculp_transp, artistic_bg, engine, precision, **kwargs):
+    # Untiled unless kwargs say otherwise
+    kwargs = dict({'mem_budget': None, 'workers': 1, 'tile_rows': None}, **kwargs)
+    imgs = combine_shadow(dict(imgs), precision)
+    precomp = dict(precomp)
+    return composite(imgs, precomp['is_fg'], precomp, sculp_transp, artistic_bg,
+                     engine=engine, precision=precision, **kwargs).astype(np.uint8)
+
+
+class TestComposite(unittest.TestCase):
+
+    def setUp(self):
+        # Weight bases go to a cache of their own
+        self.root = mkdtemp()
+        self.saved = composite_online.tmp_root, composite_online.disk_cache
+        composite_online.tmp_root = self.root
+        composite_online.disk_cache = DiskCache(self.root, 1 << 30)
+        composite_online._weight_bases.clear()
+        composite_online._weight_bases_nbytes[0] = 0
+
+    def tearDown(self):
+        composite_online.tmp_root, composite_online.disk_cache = self.saved
+        composite_online._weight_bases.clear()
+        composite_online._weight_bases_nbytes[0] = 0
+        rmtree(self.root)
+
+    def test_within_one_level(self):
+        for seed in range(2):
+            imgs, precomp = synthetic(seed=seed)
+            for sculp_transp in (0., 0.4, 0.8):
+                for artistic_bg in (False, True):
+                    ref = render(imgs, precomp, sculp_transp, artistic_bg, 'simple', 'float64')
+                    for engine in sorted(matting_engines):
+                        for precision in sorted(precisions):
+                            comp = render(imgs, precomp, sculp_transp, artistic_bg,
+                                          engine, precision)
+                            diff = np.abs(comp.astype(int) - ref).max()
+                            self.assertLessEqual(diff, 1, "%s in %s, seed %d, transp %g%s: %d" % (
+                                engine, precision, seed, sculp_transp,
+                                ", artistic" if artistic_bg else "", diff))
+
+    def test_larger_background(self):
+        # Matting only the window of the frames on a background twice as
+        # large is exact: as matting all of it, with the frames padded
+        imgs, precomp = synthetic(seed=1)
+        h, w = precomp['is_fg'].shape
+        shape = (2 * h, 2 * w)
+        rng = np.random.RandomState(2)
+        for k in [k for k in imgs if k.startswith('bg_')]:
+            imgs[k] = rng.randint(0, 256, shape + (3,)).astype(np.uint8)
+        imgs_full = {k: x if k.startswith('bg_') else centered(x, shape, 0)
+                     for k, x in imgs.iteritems()}
+        precomp_full = dict(precomp)
+        for k, fill in (('curr_idx_map', 0), ('prev_idx_map', 0), ('is_fg', False)):
+            precomp_full[k] = centered(precomp[k], shape, fill)
+        for engine in sorted(matting_engines):
+            for sculp_transp in (0., 0.4):
+                comp = render(imgs, precomp, sculp_transp, True, engine, 'float64')
+                ref = render(imgs_full, precomp_full, sculp_transp, True, engine, 'float64')
+                self.assertEqual(comp.shape, shape + (3,))
+                self.assertTrue(np.array_equal(comp, ref), "%s, transp %g" % (
+                    engine, sculp_transp))
+
+    def test_tiled_exact(self):
+        # Bands, with their halos, give exactly the untiled composite, be
+        # they set or forced by the memory budget
+        imgs, precomp = synthetic(seed=2)
+        h, w = precomp['is_fg'].shape
+        n_layers = len(precomp['idx_names']) + 1
+        for engine in sorted(matting_engines):
+            for precision in sorted(precisions):
+                # Room for two bands of a quarter of the rows, or so
+                mem_budget = 2 * estimate_peak_bytes(
+                    engine, (h // 4 + 2 * _kernel_radius(1.5), w), n_layers, precision)
+                for artistic_bg in (False, True):
+                    ref = render(imgs, precomp, 0.4, artistic_bg, engine, precision)
+                    for kwargs in ({'workers': 3, 'tile_rows': 7},
+                                   {'workers': 2, 'mem_budget': mem_budget}):
+                        comp = render(imgs, precomp, 0.4, artistic_bg, engine, precision,
+                                      **kwargs)
+                        self.assertTrue(np.array_equal(comp, ref), "%s in %s%s, %s" % (
+                            engine, precision, ", artistic" if artistic_bg else "", kwargs))
+
+    def test_over_budget(self):
+        self.assertRaises(MemoryError, _plan, 'band', 'float64', (1080, 1920), 40, 10 << 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
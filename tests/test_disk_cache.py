@@ -0,0 +1,65 @@
+"""
+Disk cache on a throwaway tree, e.g.,
+
+    python -m unittest discover tests
+"""
+
+import os
+import unittest
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from disk_cache import DiskCache
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def write(self, rel, n_bytes=10):
+        path = join(self.root, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as h:
+            h.write('x' * n_bytes)
+        return path
+
+    def test_skips_transient(self):
+        kept = self.write(join('clip', '00010.png'))
+        self.write(join('clip', '00020.png.part'))
+        fd, _ = mkstemp(dir=join(self.root, 'clip'))
+        os.close(fd)
+        tmp_dir = mkdtemp(dir=join(self.root, 'clip'))
+        self.write(join(tmp_dir, 'idx.raw'))
+        cache = DiskCache(self.root, 1 << 20)
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertTrue(cache.contains(kept))
+        self.assertEqual(cache.nbytes, 10)
+
+    def test_forgets_removed(self):
+        # As when another process removes a directory behind the index
+        path = self.write(join('clip', 'frames', '00010.png'))
+        cache = DiskCache(self.root, 1 << 20)
+        self.assertTrue(cache.contains(path))
+        rmtree(join(self.root, 'clip'))
+        cache.forget(path)
+        self.assertFalse(cache.contains(path))
+        cache.ensure_dirs([os.path.dirname(path)])
+        self.assertTrue(os.path.isdir(os.path.dirname(path)))
+
+    def test_evicts_oldest(self):
+        cache = DiskCache(self.root, 25)
+        paths = [self.write('%d.png' % i) for i in range(3)]
+        for path in paths:
+            cache.add(path)
+        cache.evict()
+        self.assertFalse(cache.contains(paths[0]))
+        self.assertTrue(cache.contains(paths[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
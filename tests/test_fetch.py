@@ -0,0 +1,202 @@
+"""
+Fetcher against a local server that drops transfers midway, e.g.,
+
+    python -m unittest discover tests
+"""
+
+import os
+import re
+import socket
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock, Thread
+import fetch
+from disk_cache import DiskCache
+from fetch import Fetcher, FileNotOnServerException, IncompleteDownload
+
+
+class DroppingHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 with Range requests, dropping the first server.drops
+    # transfers of each file a third of the way through; with
+    # server.no_length, bodies end by closing the connection instead
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        srv = self.server
+        name = self.path.lstrip('/')
+        self.send_response(200 if name in srv.files else 404)
+        self.send_header('Content-Length', str(len(srv.files.get(name, ''))))
+        self.end_headers()
+        with srv.lock:
+            srv.heads += 1
+
+    def do_GET(self):
+        srv = self.server
+        name = self.path.lstrip('/')
+        if name not in srv.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = srv.files[name]
+        start = 0
+        m = re.match(r'bytes=(\d+)-', self.headers.getheader('Range', ''))
+        if m:
+            start = int(m.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(data))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        if srv.no_length:
+            self.close_connection = 1
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        with srv.lock:
+            drop = srv.dropped.get(name, 0) < srv.drops
+            if drop:
+                srv.dropped[name] = srv.dropped.get(name, 0) + 1
+                body = body[:len(body) // 3]
+            srv.sent[name] = srv.sent.get(name, 0) + len(body)
+        self.wfile.write(body)
+        if drop:
+            self.wfile.flush()
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+
+    def log_message(self, *_):
+        pass
+
+
+class DroppingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files, drops):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), DroppingHandler)
+        self.files = files
+        self.drops = drops
+        self.dropped = {}
+        self.sent = {}
+        self.heads = 0
+        self.no_length = False
+        self.lock = Lock()
+
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.files = {
+            'a/x.bin': os.urandom(300000),
+            'a/y.bin': os.urandom(300000),
+        }
+        self.server = DroppingServer(self.files, drops=2)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.web_root = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.local_root = mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.local_root)
+
+    def _local(self, f):
+        return os.path.join(self.local_root, f)
+
+    def _read(self, f):
+        with open(self._local(f), 'rb') as h:
+            return h.read()
+
+    def test_resumes_dropped_transfers(self):
+        stats = Fetcher(self.web_root, workers=2, retries=3).fetch_all(
+            sorted(self.files), self.local_root)
+        for f, data in self.files.iteritems():
+            self.assertEqual(self._read(f), data)
+            self.assertFalse(os.path.exists(self._local(f) + '.part'))
+        # Bytes of the dropped transfers count too
+        self.assertEqual(stats['bytes'], sum(self.server.sent.values()))
+        self.assertEqual(stats['fetched'], 2)
+
+    def test_drops_file_locks(self):
+        fetcher = Fetcher(self.web_root, workers=2, retries=3)
+        fetcher.fetch_all(sorted(self.files), self.local_root)
+        self.assertEqual(fetcher._file_locks, {})
+
+    def test_too_few_retries_leave_part(self):
+        fetcher = Fetcher(self.web_root, retries=0)
+        f = 'a/x.bin'
+        self.assertRaises(IncompleteDownload, fetcher.fetch, f, self._local(f))
+        self.assertFalse(os.path.exists(self._local(f)))
+        self.assertEqual(os.path.getsize(self._local(f) + '.part'), 100000)
+        # Resumed by a later call
+        self.assertRaises(IncompleteDownload, fetcher.fetch, f, self._local(f))
+        n_bytes = fetcher.fetch(f, self._local(f))
+        self.assertEqual(self._read(f), self.files[f])
+        self.assertEqual(n_bytes, 200000 - 200000 // 3)
+
+    def test_complete_part_is_renamed(self):
+        # As left by a process that died before renaming it
+        f = 'a/x.bin'
+        os.makedirs(os.path.dirname(self._local(f)))
+        with open(self._local(f) + '.part', 'wb') as h:
+            h.write(self.files[f])
+        self.assertEqual(Fetcher(self.web_root).fetch(f, self._local(f)), 0)
+        self.assertEqual(self._read(f), self.files[f])
+        self.assertEqual(self.server.sent.get(f, 0), 0)
+
+    def test_stale_part_is_replaced(self):
+        f = 'a/x.bin'
+        os.makedirs(os.path.dirname(self._local(f)))
+        with open(self._local(f) + '.part', 'wb') as h:
+            h.write('x' * 400000)
+        Fetcher(self.web_root, retries=3).fetch(f, self._local(f))
+        self.assertEqual(self._read(f), self.files[f])
+
+    def test_no_length_rejected(self):
+        # A dropped transfer would look complete
+        self.server.no_length = True
+        f = 'a/x.bin'
+        self.assertRaises(IncompleteDownload, Fetcher(self.web_root, retries=1).fetch,
+                          f, self._local(f))
+        self.assertFalse(os.path.exists(self._local(f)))
+
+    def test_old_files_checked_once(self):
+        # Written in place before downloads went through .part files
+        truncated, complete = 'a/x.bin', 'a/y.bin'
+        os.makedirs(os.path.dirname(self._local(truncated)))
+        with open(self._local(truncated), 'wb') as h:
+            h.write(self.files[truncated][:1000])
+        with open(self._local(complete), 'wb') as h:
+            h.write(self.files[complete])
+        saved = fetch.disk_cache
+        fetch.disk_cache = DiskCache(self.local_root, 1 << 30)
+        try:
+            fetcher = Fetcher(self.web_root, retries=3)
+            for _ in range(2):
+                for f in (truncated, complete):
+                    fetcher.fetch(f, self._local(f))
+        finally:
+            fetch.disk_cache = saved
+        self.assertEqual(self._read(truncated), self.files[truncated])
+        self.assertEqual(self.server.sent.get(complete, 0), 0)
+        self.assertEqual(self.server.heads, 2)
+
+    def test_missing_file(self):
+        self.assertRaises(FileNotOnServerException, Fetcher(self.web_root).fetch,
+                          'a/z.bin', self._local('a/z.bin'))
+
+
+if __name__ == '__main__':
+    unittest.main()
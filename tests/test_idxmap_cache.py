@@ -0,0 +1,73 @@
+"""
+Compact index maps, converted on a throwaway tree, e.g.,
+
+    python -m unittest discover tests
+"""
+
+import unittest
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event, Thread
+import numpy as np
+from idxmap_cache import IdxMapCache, convert, load_compact
+
+
+class TestIdxMapCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+        rng = np.random.RandomState(0)
+        self.npz_f = join(self.root, 'density.0.00_part.Body.npz')
+        self.precomp = {
+            'idx_names': ['00000', '00010', 'sculp_Body'],
+            'curr_idx_map': rng.randint(0, 3, (60, 80)),
+            'prev_idx_map': rng.randint(0, 3, (60, 80)),
+            'is_fg': rng.rand(60, 80) > 0.5,
+        }
+        np.savez(self.npz_f, **self.precomp)
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def check(self, precomp):
+        self.assertEqual(precomp['idx_names'], self.precomp['idx_names'])
+        for k in ('curr_idx_map', 'prev_idx_map', 'is_fg'):
+            self.assertTrue(np.array_equal(precomp[k], self.precomp[k]))
+
+    def test_concurrent_convert(self):
+        # As by several processes at once, each converting the same file
+        start, errors = Event(), []
+
+        def run():
+            start.wait()
+            try:
+                convert(self.npz_f)
+            except Exception as e:  # pylint: disable=W0703
+                errors.append(e)
+
+        threads = [Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.check(load_compact(self.npz_f))
+
+    def test_concurrent_load(self):
+        cache = IdxMapCache(4, compact=True)
+        loaded = []
+        threads = [Thread(target=lambda: loaded.append(cache.load(self.npz_f)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(loaded), 8)
+        for precomp in loaded:
+            self.check(precomp)
+
+
+if __name__ == '__main__':
+    unittest.main()
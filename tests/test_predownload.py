@@ -0,0 +1,85 @@
+"""
+Predownloading folders from a local server, e.g.,
+
+    python -m unittest discover tests
+"""
+
+import os
+import tarfile
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from fetch import FileNotOnServerException
+from predownload import stream_extract, done_marker
+
+
+class FilesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.files.get(self.path.lstrip('/'))
+        self.send_response(404 if data is None else 200)
+        self.send_header('Content-Length', str(len(data or '')))
+        self.end_headers()
+        self.wfile.write(data or '')
+
+    def log_message(self, *_):
+        pass
+
+
+class FilesServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FilesHandler)
+        self.files = files
+
+
+def tar_gz(files):
+    buf = StringIO()
+    h = tarfile.open(fileobj=buf, mode='w:gz')
+    for name, data in sorted(files.iteritems()):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        h.addfile(info, StringIO(data))
+    h.close()
+    return buf.getvalue()
+
+
+class TestStreamExtract(unittest.TestCase):
+
+    def setUp(self):
+        self.files = {
+            'clip/frames.tar.gz': tar_gz({'frames/00000.jpg': 'x' * 1000}),
+        }
+        self.server = FilesServer(self.files)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.web_root = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.local_root = mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.local_root)
+
+    def test_extracts(self):
+        stream_extract('clip', 'frames', self.web_root, self.local_root)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.local_root, 'clip'))),
+                         ['frames'])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.local_root, 'clip', 'frames', done_marker)))
+
+    def test_missing_folder_leaves_nothing(self):
+        self.assertRaises(FileNotOnServerException, stream_extract, 'clip', 'render',
+                          self.web_root, self.local_root)
+        self.assertEqual(os.listdir(os.path.join(self.local_root, 'clip')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
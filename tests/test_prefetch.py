@@ -0,0 +1,63 @@
+"""
+Prefetcher thread, with downloads left out, e.g.,
+
+    python -m unittest discover tests
+"""
+
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event
+from app_config import body_parts
+from prefetch import Prefetcher
+
+
+# With a material for every part, as the UI sends
+req = {
+    'clip': 'ballet11-2',
+    'density': 0,
+    'lights': ['Left', 'Middle', 'Right'],
+    'transp': 0,
+    'spec': True,
+    'part': ['Body'],
+    'mat': {p.replace(' ', ''): 'Leather' for p in body_parts},
+}
+
+
+class FailingPrefetcher(Prefetcher):
+    # Fails to rank the first request; records what it would download
+
+    def __init__(self, tmp_root):
+        Prefetcher.__init__(self, 'http://127.0.0.1:9', tmp_root)
+        self.failed = Event()
+        self.prefetched = Event()
+
+    def rank(self, req):
+        if not self.failed.is_set():
+            self.failed.set()
+            raise ValueError("No material for ['LeftUpperArm']")
+        return Prefetcher.rank(self, req)
+
+    def _prefetch(self, req, generation):
+        self.prefetched.set()
+        return True
+
+
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def test_survives_failure(self):
+        prefetcher = FailingPrefetcher(self.root)
+        prefetcher.schedule(req)
+        self.assertTrue(prefetcher.failed.wait(5))
+        prefetcher.schedule(dict(req, density=0.2))
+        self.assertTrue(prefetcher.prefetched.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()